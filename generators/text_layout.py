@@ -0,0 +1,60 @@
+import functools
+from typing import NamedTuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+# A scratch canvas, only ever used to measure text
+MEASURING_DRAW = ImageDraw.Draw(Image.new("L", (1, 1)))
+
+
+class TextLayout(NamedTuple):
+    lines: tuple[str, ...]
+    bbox: tuple[float, float, float, float]
+
+    @property
+    def text(self):
+        return "\n".join(self.lines)
+
+
+@functools.lru_cache(maxsize=4096)
+def word_width(font: ImageFont.FreeTypeFont, word: str) -> float:
+    return font.getlength(word)
+
+
+@functools.lru_cache(maxsize=256)
+def wrap_text(
+    text: str,
+    font: ImageFont.FreeTypeFont,
+    max_width: float,
+    xy: tuple[float, float],
+    anchor: str = "ld",
+) -> TextLayout:
+    # Lay out text in a single pass over its words, breaking lines wherever the next
+    # word would take the line past max_width. Word widths are remembered per font, so
+    # the words in recurring titles are only ever measured once.
+    space = word_width(font, " ")
+
+    lines: list[str] = []
+    line_words: list[str] = []
+    line_width = 0.0
+
+    for word in text.split():
+        width = word_width(font, word)
+        width_with_word = line_width + space + width if line_words else width
+
+        if line_words and xy[0] + width_with_word > max_width:
+            lines.append(" ".join(line_words))
+            line_words = [word]
+            line_width = width
+        else:
+            line_words.append(word)
+            line_width = width_with_word
+
+    if line_words:
+        lines.append(" ".join(line_words))
+
+    bbox = MEASURING_DRAW.multiline_textbbox(
+        xy, "\n".join(lines), anchor=anchor, font=font
+    )
+
+    return TextLayout(tuple(lines), bbox)
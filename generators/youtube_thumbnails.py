@@ -1,10 +1,20 @@
+import functools
 import hashlib
 import json
+import math
+import os
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from PIL import Image, ImageDraw, ImageFilter, ImageFont
 
-FONT_LATO_BOLD_LG = ImageFont.truetype("fonts/Lato-Bold.ttf", 56)
-FONT_LATO_REGULAR_MD = ImageFont.truetype("fonts/Lato-Regular.ttf", 42)
+from generators.text_layout import wrap_text
+
+FONT_LATO_BOLD_PATH = "fonts/Lato-Bold.ttf"
+FONT_LATO_REGULAR_PATH = "fonts/Lato-Regular.ttf"
+
+FONT_LATO_BOLD_LG = ImageFont.truetype(FONT_LATO_BOLD_PATH, 56)
+FONT_LATO_REGULAR_MD = ImageFont.truetype(FONT_LATO_REGULAR_PATH, 42)
 
 GENERATOR_VERSION = 3
 
@@ -14,6 +24,36 @@ RIGHT_MARGIN = 120
 BOTTOM_MARGIN = 90
 SPACING_BETWEEN_TEXT = 8
 
+SHADOW_BLUR_RADIUS = 7
+SHADOW_COLOUR = "#030303"
+TEXT_COLOUR = "#FFF"
+
+# Prepared backgrounds are 1280x720, so each one holds a few megabytes
+BACKGROUND_CACHE_SIZE = 8
+
+_backgrounds: OrderedDict = OrderedDict()
+
+
+@functools.lru_cache(maxsize=None)
+def _file_digest(path, size, modified):
+    # Size and modification time are only part of the cache key, so edited files get
+    # hashed again
+    with open(path, "rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+
+
+def file_digest(path):
+    stat = os.stat(path)
+    return _file_digest(path, stat.st_size, stat.st_mtime_ns)
+
+
+def fonts_digest():
+    return hashlib.sha256(
+        "".join(
+            file_digest(path) for path in (FONT_LATO_BOLD_PATH, FONT_LATO_REGULAR_PATH)
+        ).encode("utf-8")
+    ).hexdigest()
+
 
 class YoutubeThumbnail:
     def __init__(self, service):
@@ -26,9 +66,10 @@ class YoutubeThumbnail:
     @property
     def generated_image_hash(self):
         data_hash_dict = {
-            "image": self.service_image_path,
+            "image": file_digest(self.service_image_path),
+            "fonts": fonts_digest(),
             "title": self.service.title_string,
-            "datetime": self.service.datetime_localised.strftime("%-d %B %Y"),
+            "datetime": self.service.date_string,
             "version": GENERATOR_VERSION,
         }
 
@@ -42,112 +83,218 @@ class YoutubeThumbnail:
             hash=self.generated_image_hash
         )
 
+    @property
+    def render_job(self):
+        return {
+            "source_path": self.service_image_path,
+            "title": self.service.title_string,
+            "date": self.service.date_string,
+            "output_path": self.generated_image_path,
+        }
+
+    @property
+    def is_generated(self):
+        return os.path.isfile(self.generated_image_path)
+
     def generate(self):
-        with Image.open(self.service_image_path) as thumb_image:
-            # Thumbnail the image, which handles cropping and resizing down (but not up)
-            thumb_image.thumbnail(TARGET_THUMBNAIL_DIMENSIONS)
-
-            # Resize the image, which scales it back up if necessary
-            sized_image = thumb_image.resize(TARGET_THUMBNAIL_DIMENSIONS)
-
-            # Create piece of canvas to draw text on and blur
-            blurred = Image.new("RGBA", sized_image.size)
-            draw = ImageDraw.Draw(blurred)
-
-            # Text we want to actually write
-            main_text = self.service.title_string
-            aux_text = self.service.datetime_localised.strftime("%-d %B %Y")
-
-            main_text_draw_coordinates = (
-                LEFT_MARGIN,
-                TARGET_THUMBNAIL_DIMENSIONS[1] - 10 - BOTTOM_MARGIN,
-            )
-
-            # Figure out the bounding boxes for our main text
-            main_text_bounding = draw.textbbox(
-                main_text_draw_coordinates,
-                main_text,
-                anchor="ld",
-                font=FONT_LATO_BOLD_LG,
-            )
-
-            main_text_max_width = (
-                TARGET_THUMBNAIL_DIMENSIONS[0] - LEFT_MARGIN - RIGHT_MARGIN
-            )
-
-            # Is the text wider than our margins? If not, rock on. If it is, we need to do some wrapping.
-            if main_text_bounding[2] > main_text_max_width:
-                # Start with an empty string
-                main_text_with_breaks = ""
-
-                for word in main_text.split():
-                    # Figure out the size of the box with the new word
-                    text_to_test = main_text_with_breaks + word
-                    main_text_bounding = draw.multiline_textbbox(
-                        main_text_draw_coordinates,
-                        text_to_test,
-                        anchor="ld",
-                        font=FONT_LATO_BOLD_LG,
-                    )
-
-                    if main_text_bounding[2] > main_text_max_width:
-                        # It's too big, throw in a break
-                        main_text_with_breaks += "\n"
-
-                    main_text_with_breaks += word + " "
-
-                # We're done calculating breakpoints, move the broken text to the main variable
-                # and recalculate bounding box
-                main_text = main_text_with_breaks
-                main_text_bounding = draw.multiline_textbbox(
-                    main_text_draw_coordinates,
-                    main_text,
-                    anchor="ld",
-                    font=FONT_LATO_BOLD_LG,
-                )
-
-            aux_text_draw_coordinates = (
-                LEFT_MARGIN,
-                main_text_bounding[1] - SPACING_BETWEEN_TEXT,
-            )
-
-            draw.multiline_text(
-                xy=main_text_draw_coordinates,
-                text=main_text,
-                fill="#030303",
-                font=FONT_LATO_BOLD_LG,
-                anchor="ld",
-            )
-            draw.text(
-                xy=aux_text_draw_coordinates,
-                text=aux_text,
-                fill="#030303",
-                font=FONT_LATO_REGULAR_MD,
-                anchor="ld",
-            )
-            blurred = blurred.filter(ImageFilter.BoxBlur(7))
-
-            # Paste soft text onto background
-            sized_image.paste(blurred, blurred)
-
-            # Draw on sharp text
-            draw = ImageDraw.Draw(sized_image)
-            draw.text(
-                xy=main_text_draw_coordinates,
-                text=main_text,
-                fill="#FFF",
-                font=FONT_LATO_BOLD_LG,
-                anchor="ld",
-            )
-            draw.text(
-                xy=aux_text_draw_coordinates,
-                text=aux_text,
-                fill="#FFF",
-                font=FONT_LATO_REGULAR_MD,
-                anchor="ld",
-            )
-
-            sized_image.save(
-                self.generated_image_path,
-                format="JPEG",
-            )
+        # The output path is keyed on everything that goes into the image, so if it
+        # exists it's already exactly what we'd draw
+        if not self.is_generated:
+            render_thumbnail(**self.render_job)
+
+
+def prepare_background(source_path):
+    with Image.open(source_path) as thumb_image:
+        # Have JPEGs decoded at the smallest scale that's still at least our target size,
+        # rather than decoding every pixel of a large source just to throw most away
+        thumb_image.draft(None, TARGET_THUMBNAIL_DIMENSIONS)
+
+        # Thumbnail the image, which handles cropping and resizing down (but not up)
+        thumb_image.thumbnail(TARGET_THUMBNAIL_DIMENSIONS, reducing_gap=None)
+
+        # Resize the image, which scales it back up if necessary
+        return thumb_image.resize(TARGET_THUMBNAIL_DIMENSIONS)
+
+
+def background(source_path):
+    # Most services share one of a handful of default images, so keep the prepared
+    # backgrounds around, keyed by content, and hand out copies to draw on
+    digest = file_digest(source_path)
+
+    if digest in _backgrounds:
+        _backgrounds.move_to_end(digest)
+    else:
+        _backgrounds[digest] = prepare_background(source_path)
+
+        while len(_backgrounds) > BACKGROUND_CACHE_SIZE:
+            _backgrounds.popitem(last=False)
+
+    return _backgrounds[digest].copy()
+
+
+def compose_thumbnail(source_path, title, date):
+    sized_image = background(source_path)
+
+    # Text we want to actually write
+    main_text = title
+    aux_text = date
+
+    main_text_draw_coordinates = (
+        LEFT_MARGIN,
+        TARGET_THUMBNAIL_DIMENSIONS[1] - 10 - BOTTOM_MARGIN,
+    )
+
+    main_text_max_width = TARGET_THUMBNAIL_DIMENSIONS[0] - LEFT_MARGIN - RIGHT_MARGIN
+
+    # Wrap the main text if it's wider than our margins
+    main_text_layout = wrap_text(
+        main_text,
+        FONT_LATO_BOLD_LG,
+        main_text_max_width,
+        main_text_draw_coordinates,
+    )
+
+    main_text = main_text_layout.text
+    main_text_bounding = main_text_layout.bbox
+
+    aux_text_draw_coordinates = (
+        LEFT_MARGIN,
+        main_text_bounding[1] - SPACING_BETWEEN_TEXT,
+    )
+
+    # Rasterise the text just once, as a mask for both the shadow and the sharp text
+    text_mask = Image.new("L", sized_image.size)
+    draw = ImageDraw.Draw(text_mask)
+    draw.multiline_text(
+        xy=main_text_draw_coordinates,
+        text=main_text,
+        fill=255,
+        font=FONT_LATO_BOLD_LG,
+        anchor="ld",
+    )
+    draw.text(
+        xy=aux_text_draw_coordinates,
+        text=aux_text,
+        fill=255,
+        font=FONT_LATO_REGULAR_MD,
+        anchor="ld",
+    )
+
+    text_region = text_mask.getbbox()
+
+    if not text_region:
+        return sized_image
+
+    # Only the text, plus enough room for the blur to spread, needs blurring
+    text_region = (
+        max(text_region[0] - 2 * SHADOW_BLUR_RADIUS, 0),
+        max(text_region[1] - 2 * SHADOW_BLUR_RADIUS, 0),
+        min(text_region[2] + 2 * SHADOW_BLUR_RADIUS, sized_image.width),
+        min(text_region[3] + 2 * SHADOW_BLUR_RADIUS, sized_image.height),
+    )
+    text_region_mask = text_mask.crop(text_region)
+
+    # Paste soft text onto background
+    sized_image.paste(
+        SHADOW_COLOUR,
+        text_region,
+        text_region_mask.filter(ImageFilter.BoxBlur(SHADOW_BLUR_RADIUS)),
+    )
+
+    # Then the sharp text on top
+    sized_image.paste(TEXT_COLOUR, text_region, text_region_mask)
+
+    return sized_image
+
+
+def render_thumbnail(source_path, title, date, output_path):
+    sized_image = compose_thumbnail(source_path, title, date)
+
+    # Write somewhere temporary first, so a half-written file never looks cached
+    temporary_output_path = "{path}.{pid}.tmp".format(path=output_path, pid=os.getpid())
+
+    sized_image.save(
+        temporary_output_path,
+        format="JPEG",
+    )
+
+    os.replace(temporary_output_path, output_path)
+
+
+def render_thumbnails(jobs):
+    # Render a run of jobs in one worker, so jobs sharing a source share its background
+    errors = {}
+
+    for job in jobs:
+        try:
+            render_thumbnail(**job)
+        except Exception as e:
+            errors[job["output_path"]] = e
+
+    return errors
+
+
+def generate_thumbnails(thumbnails, max_workers=None):
+    # Render a batch of thumbnails across a pool of processes, returning any errors
+    # keyed by service ID so one bad image doesn't stop the rest
+    service_ids_by_output_path = defaultdict(list)
+    jobs = {}
+    errors = {}
+
+    for thumbnail in thumbnails:
+        try:
+            if thumbnail.is_generated:
+                continue
+
+            job = thumbnail.render_job
+        except Exception as e:
+            errors[thumbnail.service.id] = repr(e)
+            continue
+
+        # Identical thumbnails share an output path, so only render them once
+        jobs[job["output_path"]] = job
+        service_ids_by_output_path[job["output_path"]].append(thumbnail.service.id)
+
+    def record_error(output_path, error):
+        for service_id in service_ids_by_output_path[output_path]:
+            errors[service_id] = repr(error)
+
+    if len(jobs) <= 1 or max_workers == 1:
+        for output_path, error in render_thumbnails(jobs.values()).items():
+            record_error(output_path, error)
+
+        return errors
+
+    # Group jobs by source image, then split the groups into chunks small enough to
+    # keep every worker busy. Each chunk prepares its background once.
+    jobs_by_source = defaultdict(list)
+
+    for job in jobs.values():
+        try:
+            source = file_digest(job["source_path"])
+        except OSError:
+            source = job["source_path"]
+
+        jobs_by_source[source].append(job)
+
+    workers = max_workers or os.cpu_count() or 1
+    chunk_size = math.ceil(len(jobs) / workers)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+
+        for source_jobs in jobs_by_source.values():
+            for start in range(0, len(source_jobs), chunk_size):
+                chunk = source_jobs[start : start + chunk_size]
+                futures[executor.submit(render_thumbnails, chunk)] = chunk
+
+        for future in as_completed(futures):
+            try:
+                chunk_errors = future.result()
+            except Exception as e:
+                chunk_errors = {job["output_path"]: e for job in futures[future]}
+
+            for output_path, error in chunk_errors.items():
+                record_error(output_path, error)
+
+    return errors
@@ -1,11 +1,138 @@
 import os
+import threading
+import time
+from typing import Optional
 
+import click
 from pyairtable import Table
 
+from interfaces import http
+
 AIRTABLE_API_KEY = os.environ["AIRTABLE_API_KEY"]
 AIRTABLE_BASE_ID = os.environ["AIRTABLE_BASE_ID"]
 AIRTABLE_SERVICES_TABLE_ID = os.environ["AIRTABLE_SERVICES_TABLE_ID"]
 
+# Airtable allows 5 requests a second to each base, and counts them a second at a time,
+# so space them out rather than letting them bunch up
+AIRTABLE_REQUESTS_PER_SECOND = 5
+AIRTABLE_BURST = 1
+
+# How long Airtable makes us wait after going over the limit, unless it says otherwise
+AIRTABLE_RATE_LIMIT_PENALTY = 30
+AIRTABLE_RATE_LIMIT_RETRIES = 3
+
+# Rate limiting is handled by the session itself, so leave 429s out of the retries
+AIRTABLE_RETRY_STATUSES = tuple(
+    status for status in http.RETRY_STATUSES if status != 429
+)
+
+
+class RateLimiter:
+    # A token bucket shared between threads. Tokens can be borrowed against the future,
+    # so each caller knows how long to wait without holding the lock while it does.
+    def __init__(
+        self, rate: float = AIRTABLE_REQUESTS_PER_SECOND, burst: int = AIRTABLE_BURST
+    ) -> None:
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self) -> float:
+        with self.lock:
+            self.refill()
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+        if wait:
+            time.sleep(wait)
+
+        return wait
+
+    def pause(self, seconds: float) -> None:
+        # Hold everyone back, not just whoever was turned away
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class Session(http.Session):
+    # Keeps every request to Airtable within the rate limit, and waits out the penalty
+    # if we go over it anyway
+    def __init__(self, limiter: Optional[RateLimiter] = None) -> None:
+        super().__init__(retry=http.retry_strategy(statuses=AIRTABLE_RETRY_STATUSES))
+
+        self.limiter = limiter or RateLimiter()
+        self.requests_made = 0
+        self.rate_limited = 0
+        self.throttled_seconds = 0.0
+        self.counter_lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        # pyairtable sends prepared requests itself, with no timeout unless given one
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+
+        for attempt in range(AIRTABLE_RATE_LIMIT_RETRIES + 1):
+            waited = self.limiter.acquire()
+            response = super().send(request, **kwargs)
+
+            with self.counter_lock:
+                self.requests_made += 1
+                self.throttled_seconds += waited
+
+            if response.status_code != 429 or attempt == AIRTABLE_RATE_LIMIT_RETRIES:
+                return response
+
+            with self.counter_lock:
+                self.rate_limited += 1
+
+            self.limiter.pause(
+                float(response.headers.get("Retry-After", AIRTABLE_RATE_LIMIT_PENALTY))
+            )
+            response.close()
+
+    def report(self) -> None:
+        click.echo(
+            "Airtable: {requests} requests, {limited} rate limited, "
+            "{throttled:.1f}s throttled".format(
+                requests=self.requests_made,
+                limited=self.rate_limited,
+                throttled=self.throttled_seconds,
+            )
+        )
+
+
+_session: Optional[Session] = None
+_services_table: Optional[Table] = None
+
+
+def session() -> Session:
+    # One connection, and one rate limit, for everything talking to Airtable
+    global _session
+
+    if _session is None:
+        _session = Session()
+
+    return _session
+
 
 def services_table() -> Table:
-    return Table(AIRTABLE_API_KEY, AIRTABLE_BASE_ID, AIRTABLE_SERVICES_TABLE_ID)
+    global _services_table
+
+    if _services_table is None:
+        _services_table = Table(
+            AIRTABLE_API_KEY, AIRTABLE_BASE_ID, AIRTABLE_SERVICES_TABLE_ID
+        )
+
+        # Setting the key again puts its header on the shared session
+        _services_table.session = session()
+        _services_table.api_key = AIRTABLE_API_KEY
+
+    return _services_table
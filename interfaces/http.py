@@ -0,0 +1,76 @@
+import base64
+from typing import Optional
+
+import requests
+import urllib3.util.retry
+from requests.adapters import HTTPAdapter
+
+# Seconds to wait to connect, and then for a response
+DEFAULT_TIMEOUT = (5, 60)
+
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 1
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Writes aren't safe to repeat unless the server has told us it didn't act on them
+RETRY_WRITE_STATUSES = (429, 503)
+
+POOL_MAXSIZE = 10
+
+
+class Retry(urllib3.util.retry.Retry):
+    def is_retry(self, method, status_code, has_retry_after=False):
+        # Only ever retry the statuses we've asked for, Retry-After or not
+        if status_code not in (self.status_forcelist or ()):
+            return False
+
+        if not self._is_method_retryable(method):
+            return bool(self.total) and status_code in RETRY_WRITE_STATUSES
+
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def retry_strategy(statuses=RETRY_STATUSES) -> Retry:
+    # Backs off exponentially, but waits for as long as a Retry-After header asks
+    return Retry(
+        total=RETRY_TOTAL,
+        backoff_factor=RETRY_BACKOFF_FACTOR,
+        status_forcelist=statuses,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+
+def basic_auth_header(user: str, password: str) -> dict[str, str]:
+    token = base64.b64encode("{}:{}".format(user, password).encode())
+    return {"Authorization": "Basic " + token.decode("utf-8")}
+
+
+class Session(requests.Session):
+    # A keep-alive session, so repeated calls to the same host share one connection
+    # (and one TLS handshake), with a timeout on everything and retries built in
+    def __init__(
+        self,
+        headers: Optional[dict[str, str]] = None,
+        timeout=DEFAULT_TIMEOUT,
+        retry: Optional[Retry] = None,
+    ):
+        super().__init__()
+
+        self.timeout = timeout
+
+        if headers:
+            self.headers.update(headers)
+
+        adapter = HTTPAdapter(
+            max_retries=retry or retry_strategy(),
+            pool_connections=POOL_MAXSIZE,
+            pool_maxsize=POOL_MAXSIZE,
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+
+        return super().request(method, url, **kwargs)
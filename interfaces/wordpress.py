@@ -1,12 +1,17 @@
-import base64
+import datetime
+import hashlib
+import json
+import mimetypes
 import os
-import urllib.request
+import tempfile
+import time
+from typing import Any, Callable, Iterable, NamedTuple, Optional
 
 import click
-import requests
 from requests_toolbelt.multipart.encoder import MultipartEncoder
 
-from services import AIRTABLE_MAP
+from interfaces import http
+from services import AIRTABLE_MAP, TZ_LONDON
 
 WORDPRESS_BASE_URL = "https://whitkirkchurch.org.uk"
 WORDPRESS_USER = os.environ["WORDPRESS_USER"]
@@ -18,21 +23,486 @@ url = "{base_url}/wp-json/wp/v2/whitkirk_oos".format(base_url=WORDPRESS_BASE_URL
 media_url = "{base_url}/wp-json/wp/v2/media".format(base_url=WORDPRESS_BASE_URL)
 podcast_url = "{base_url}/wp-json/wp/v2/podcast".format(base_url=WORDPRESS_BASE_URL)
 
+api_root = "{base_url}/wp-json".format(base_url=WORDPRESS_BASE_URL)
+batch_url = "{api_root}/batch/v1".format(api_root=api_root)
+
+# The most requests WordPress will accept in one batch, unless the site says otherwise
+WORDPRESS_BATCH_SIZE = 25
+
+# The most the REST API will return in one page
+WORDPRESS_PER_PAGE = 100
+
+WORDPRESS_MEDIA_INDEX_PATH = os.environ.get(
+    "WORDPRESS_MEDIA_INDEX_PATH", "wordpress_media.json"
+)
+
+# Marks an image identity as a content digest, rather than an old-style filename
+MEDIA_DIGEST_PREFIX = "sha256:"
+
+# Just the parts of a post we compare against, not the whole rendered thing
+POST_FIELDS = "id,title,slug,date,acf,excerpt,content,featured_media"
+
+
+_session: Optional[http.Session] = None
+_upload_session: Optional[http.Session] = None
+
 
 def auth_header():
-    user = WORDPRESS_USER
-    password = WORDPRESS_APPLICATION_PASSWORD
-    credentials = user + ":" + password
-    token = base64.b64encode(credentials.encode())
-    return {"Authorization": "Basic " + token.decode("utf-8")}
+    return http.basic_auth_header(WORDPRESS_USER, WORDPRESS_APPLICATION_PASSWORD)
+
+
+def session() -> http.Session:
+    # One authenticated connection to the site, kept open for the whole run
+    global _session
+
+    if _session is None:
+        _session = http.Session(headers=auth_header())
+
+    return _session
+
+
+ResponseCallback = Callable[[dict[str, Any]], None]
+
+
+class QueuedWrite(NamedTuple):
+    method: str
+    endpoint_url: str
+    body: Optional[dict[str, Any]]
+    on_response: Optional[ResponseCallback]
+
+
+class WriteQueue:
+    # Collects writes and sends them through the REST batch endpoint, falling back to
+    # one request each if the site won't batch them
+    def __init__(self, batch_size: int = WORDPRESS_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.supported = True
+        self.writes: list[QueuedWrite] = []
+
+    def __len__(self) -> int:
+        return len(self.writes)
+
+    def add(
+        self,
+        endpoint_url: str,
+        body: Optional[dict[str, Any]] = None,
+        on_response: Optional[ResponseCallback] = None,
+        method: str = "POST",
+    ) -> None:
+        self.writes.append(QueuedWrite(method, endpoint_url, body, on_response))
+
+        if len(self.writes) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        while self.writes:
+            writes = self.writes[: self.batch_size]
+            self.writes = self.writes[self.batch_size :]
+
+            if self.supported and len(writes) > 1:
+                self.send_batch(writes)
+            else:
+                for queued in writes:
+                    send(queued)
+
+    def send_batch(self, writes: list[QueuedWrite]) -> None:
+        requests = []
+
+        for queued in writes:
+            request: dict[str, Any] = {
+                "method": queued.method,
+                "path": queued.endpoint_url[len(api_root) :],
+            }
+
+            if queued.body is not None:
+                request["body"] = queued.body
+
+            requests.append(request)
+
+        response = session().post(batch_url, json={"requests": requests})
+
+        if response.status_code == 404:
+            click.echo(
+                click.style("Batching isn't available, writing singly", fg="yellow")
+            )
+            self.supported = False
+
+            for queued in writes:
+                send(queued)
+
+            return
+
+        if not response.ok:
+            # WordPress may have run some of these already, so sending them again could
+            # create things twice. Leave them for the next run to find.
+            click.echo(
+                click.style(
+                    "Batch of {count} writes failed ({status}), leaving for next "
+                    "time".format(count=len(writes), status=response.status_code),
+                    fg="red",
+                )
+            )
+            return
+
+        result = response.json()
+
+        # If any of the requests is invalid, WordPress runs none of them
+        if result.get("failed") == "validation":
+            for queued in writes:
+                send(queued)
+
+            return
+
+        for queued, sub_response in zip(writes, result["responses"]):
+            body = sub_response.get("body") or {}
+
+            if body.get("code") == "rest_batch_not_allowed":
+                send(queued)
+            else:
+                handle_response(queued, sub_response["status"], body)
+
+
+def handle_response(queued: QueuedWrite, status: int, body: dict[str, Any]) -> None:
+    if status >= 400:
+        click.echo(
+            click.style(
+                "Couldn't write to {url} ({status}): {message}".format(
+                    url=queued.endpoint_url, status=status, message=body.get("message")
+                ),
+                fg="red",
+            )
+        )
+    elif queued.on_response:
+        queued.on_response(body)
+
+
+def response_body(response) -> dict[str, Any]:
+    try:
+        return response.json()
+    except ValueError:
+        return {}
+
+
+def send(queued: QueuedWrite) -> None:
+    response = session().request(queued.method, queued.endpoint_url, json=queued.body)
+
+    handle_response(queued, response.status_code, response_body(response))
+
+
+def write(
+    endpoint_url: str,
+    body: dict[str, Any],
+    on_response: Optional[ResponseCallback] = None,
+    queue: Optional[WriteQueue] = None,
+) -> None:
+    if queue is None:
+        send(QueuedWrite("POST", endpoint_url, body, on_response))
+    else:
+        queue.add(endpoint_url, body, on_response)
+
+
+def delete_media(media_id, queue: Optional[WriteQueue] = None) -> None:
+    # Attachments can't be trashed, so they have to be deleted outright
+    endpoint_url = media_url + "/{}?force=true".format(media_id)
+
+    if queue is None:
+        send(QueuedWrite("DELETE", endpoint_url, None, None))
+    else:
+        queue.add(endpoint_url, method="DELETE")
+
+
+def upload_session() -> http.Session:
+    # An upload body is streamed from the file and can't be rewound, so the connection
+    # mustn't retry it by itself. upload_media retries with a fresh body instead.
+    global _upload_session
+
+    if _upload_session is None:
+        _upload_session = http.Session(
+            headers=auth_header(), retry=http.Retry(total=0, raise_on_status=False)
+        )
+
+    return _upload_session
+
+
+def upload_media(
+    image_path: str, filename: str, fields: dict[str, Any]
+) -> Optional[dict[str, Any]]:
+    # The encoder reads the file as the request goes out, so however large the image,
+    # only a chunk of it is in memory at once
+    content_type = mimetypes.guess_type(filename)[0] or "image/jpeg"
+
+    for attempt in range(http.RETRY_TOTAL + 1):
+        with open(image_path, "rb") as image_file:
+            multipart_data = MultipartEncoder(
+                {**fields, "file": (filename, image_file, content_type)}
+            )
+
+            response = upload_session().post(
+                media_url,
+                data=multipart_data,
+                headers={"Content-Type": multipart_data.content_type},
+            )
+
+        # Only retry when WordPress has told us it didn't take the upload
+        if (
+            response.status_code not in http.RETRY_WRITE_STATUSES
+            or attempt == http.RETRY_TOTAL
+        ):
+            break
+
+        time.sleep(
+            float(
+                response.headers.get(
+                    "Retry-After", http.RETRY_BACKOFF_FACTOR * 2**attempt
+                )
+            )
+        )
+
+    if not response.ok:
+        click.echo(
+            click.style(
+                "Couldn't upload {filename} ({status})".format(
+                    filename=filename, status=response.status_code
+                ),
+                fg="red",
+            )
+        )
+        return None
+
+    return response.json()
+
+
+def media_digest(image_path: str) -> str:
+    with open(image_path, "rb") as image_file:
+        return (
+            MEDIA_DIGEST_PREFIX + hashlib.file_digest(image_file, "sha256").hexdigest()
+        )
+
+
+class MediaIndex:
+    # Which attachment holds each image we've uploaded, by content digest, and which
+    # services use it, so that services with the same image can share one upload
+    def __init__(self, index_path: str = WORDPRESS_MEDIA_INDEX_PATH):
+        self.index_path = index_path
+
+        try:
+            with open(self.index_path) as index_file:
+                self.index: dict[str, dict[str, Any]] = json.load(index_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.index = {}
+
+    def media_id(self, digest: str) -> Optional[str]:
+        entry = self.index.get(digest)
+        return entry["id"] if entry else None
+
+    def users(self, media_id) -> list[str]:
+        return [
+            service_id
+            for entry in self.index.values()
+            if entry["id"] == str(media_id)
+            for service_id in entry["services"]
+        ]
+
+    def use(self, digest: str, media_id, service_id: str) -> None:
+        entry = self.index.setdefault(digest, {"id": str(media_id), "services": []})
+        entry["id"] = str(media_id)
+
+        if service_id not in entry["services"]:
+            entry["services"].append(service_id)
+
+    def release(self, media_id, service_id: str) -> bool:
+        # Returns whether anything we know of still uses the attachment
+        for digest, entry in list(self.index.items()):
+            if entry["id"] != str(media_id):
+                continue
+
+            if service_id in entry["services"]:
+                entry["services"].remove(service_id)
+
+            if not entry["services"]:
+                del self.index[digest]
+
+        return bool(self.users(media_id))
+
+    def save(self) -> None:
+        directory = os.path.dirname(os.path.abspath(self.index_path))
+
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, delete=False
+        ) as index_file:
+            json.dump(self.index, index_file, indent=2, sort_keys=True)
+
+        os.replace(index_file.name, self.index_path)
+
+
+_media_index: Optional[MediaIndex] = None
+
+
+def media_index() -> MediaIndex:
+    global _media_index
+
+    if _media_index is None:
+        _media_index = MediaIndex()
+
+    return _media_index
+
+
+def use_featured_image(
+    service_object,
+    services_table,
+    image_path: str,
+    filename: str,
+    digest: str,
+    fields: dict[str, Any],
+    queue: Optional[WriteQueue] = None,
+) -> Optional[int]:
+    # Point a service at an attachment with this image in, only uploading it if no
+    # other service has already
+    index = media_index()
+
+    # Only an attachment this service uploaded itself is its own to get rid of
+    previous_id = service_object.wordpress_image_id
+    owned_previous_id = (
+        previous_id if service_object.wordpress_image_last_uploaded_name else None
+    )
+
+    media_id = index.media_id(digest)
+
+    if media_id:
+        click.echo("Image already uploaded, reusing attachment {}".format(media_id))
+    else:
+        response = upload_media(image_path, filename, fields)
+
+        if not response:
+            return None
+
+        media_id = str(response["id"])
+
+    services_table.update(
+        service_object.id,
+        {
+            AIRTABLE_MAP["wp_image_id"]: str(media_id),
+            AIRTABLE_MAP["wp_image_last_uploaded_name"]: digest,
+        },
+    )
+    index.use(digest, media_id, service_object.id)
+
+    if (
+        owned_previous_id
+        and str(owned_previous_id) != str(media_id)
+        and not index.release(owned_previous_id, service_object.id)
+    ):
+        delete_media(owned_previous_id, queue=queue)
+
+    return int(media_id)
+
+
+def fetch_posts(endpoint_url: str, post_ids: Iterable) -> dict[str, dict[str, Any]]:
+    # Get the current state of a set of posts in as few requests as possible, keyed by
+    # ID. Anything we can't fetch is just missing, and so gets written as before.
+    post_ids = list(dict.fromkeys(str(post_id) for post_id in post_ids if post_id))
+    posts = {}
+
+    for start in range(0, len(post_ids), WORDPRESS_PER_PAGE):
+        chunk = post_ids[start : start + WORDPRESS_PER_PAGE]
+
+        response = session().get(
+            endpoint_url,
+            params={
+                "include": ",".join(chunk),
+                "per_page": str(WORDPRESS_PER_PAGE),
+                "context": "edit",
+                "status": "any",
+                "_fields": POST_FIELDS,
+            },
+        )
+
+        if not response.ok:
+            click.echo(
+                click.style(
+                    "Couldn't fetch existing posts ({status})".format(
+                        status=response.status_code
+                    ),
+                    fg="yellow",
+                )
+            )
+            continue
+
+        for post in response.json():
+            posts[str(post["id"])] = post
+
+    return posts
+
+
+def raw_value(value: Any) -> Any:
+    # In the edit context, text fields come back as both raw and rendered
+    if isinstance(value, dict) and "raw" in value:
+        return value["raw"]
+
+    return value
+
+
+def acf_value_matches(existing: Any, desired: Any) -> bool:
+    # ACF hands booleans back however the field happens to store them
+    if isinstance(desired, bool):
+        return existing in (desired, int(desired), str(int(desired)))
+
+    return existing == desired
+
+
+def post_date(value: str) -> datetime.datetime:
+    # WordPress keeps post dates as naive site-local times
+    date = datetime.datetime.fromisoformat(value)
+
+    if date.tzinfo is not None:
+        date = date.astimezone(TZ_LONDON).replace(tzinfo=None)
+
+    return date
+
+
+def post_matches(existing: Optional[dict[str, Any]], desired: dict[str, Any]) -> bool:
+    if not existing:
+        return False
+
+    for key, value in desired.items():
+        if key not in existing:
+            return False
+
+        if key == "acf":
+            existing_acf = existing["acf"] or {}
+
+            if not all(
+                field in existing_acf and acf_value_matches(existing_acf[field], v)
+                for field, v in value.items()
+            ):
+                return False
+
+        elif key == "date":
+            if post_date(existing["date"]) != post_date(value):
+                return False
+
+        elif key == "featured_media":
+            if str(existing["featured_media"]) != str(value):
+                return False
+
+        elif raw_value(existing[key]) != value:
+            return False
+
+    return True
 
 
 def create_or_update_oos_entry(
-    service_object, previous_service, services_table, update
+    service_object,
+    previous_service,
+    services_table,
+    update,
+    existing_post=None,
+    queue=None,
 ):
     # Establish service defaults
 
     service_image = None
+    service_image_filename = None
     show_bcp_reproduction_notice = False
     featured_image_id = WORDPRESS_DEFAULT_FEATURED_IMAGE_ID
 
@@ -80,14 +550,9 @@ def create_or_update_oos_entry(
 
     if service_object.churchsuite_image_field:
         click.echo(click.style("Service-specific image found...", fg="blue"))
-        image_data = service_object.churchsuite_image_field[0]
-        image_url = image_data["url"]
-        image_save_location = "images/service_specific/{}".format(
-            image_data["filename"]
-        )
-        urllib.request.urlretrieve(image_url, image_save_location)
-
-        service_image = image_save_location
+        service_image = service_object.service_image
+        service_image_filename = service_object.churchsuite_image_field[0]["filename"]
+        service_image_digest = media_digest(service_image)
 
     media_resource_body = {
         "title": "Featured image for {}".format(service_object.title_string_with_date),
@@ -103,22 +568,41 @@ def create_or_update_oos_entry(
         if service_object.churchsuite_image_field:
             click.echo("Featured image is service-specific")
 
-            # Get the resource metadata, so we can compare the filename
+            # Compare what we last uploaded with what the image is now. Older records
+            # have the filename, which we take as still current and swap for a digest.
 
-            last_uploaded_file = service_object.wordpress_image_last_uploaded_name
-            image_filename_from_airtable = service_object.churchsuite_image_field[0][
-                "filename"
-            ]
+            last_uploaded = service_object.wordpress_image_last_uploaded_name
+
+            if service_object.wordpress_image_id and last_uploaded in (
+                service_image_digest,
+                service_image_filename,
+            ):
+                # This is the same image, so just poke the metadata
+                click.echo("WP and CS images match")
+
+                media_index().use(
+                    service_image_digest, featured_image_id, service_object.id
+                )
 
-            if last_uploaded_file == image_filename_from_airtable:
-                # This is the same image idenfitier, so just poke the metadata
-                click.echo("WP and CS identifiers for image match")
                 if update:
-                    requests.post(
-                        media_url + "/{}".format(featured_image_id),
-                        headers=auth_header(),
-                        json=media_resource_body,
-                    )
+                    if last_uploaded != service_image_digest:
+                        services_table.update(
+                            service_object.id,
+                            {
+                                AIRTABLE_MAP[
+                                    "wp_image_last_uploaded_name"
+                                ]: service_image_digest
+                            },
+                        )
+
+                    # A shared attachment can't be described as belonging to just one
+                    # service
+                    if media_index().users(featured_image_id) == [service_object.id]:
+                        write(
+                            media_url + "/{}".format(featured_image_id),
+                            media_resource_body,
+                            queue=queue,
+                        )
                 else:
                     click.echo(
                         click.style(
@@ -127,46 +611,28 @@ def create_or_update_oos_entry(
                         )
                     )
             else:
-                # This is a different image, nuke the old one and replace
+                # This is a different image, so use the new one, and only then get rid
+                # of the old one
 
                 click.echo("Image has changed, replacing")
 
-                fileName = os.path.basename(service_image)
-
-                with open(service_image, "rb") as service_image_file:
-                    media_resource_body["file"] = (
-                        fileName,
-                        service_image_file,
-                        "image/jpeg",
+                if update:
+                    media_id = use_featured_image(
+                        service_object,
+                        services_table,
+                        service_image,
+                        service_image_filename,
+                        service_image_digest,
+                        media_resource_body,
+                        queue=queue,
                     )
 
-                    multipart_data = MultipartEncoder(media_resource_body)
-
-                    if update:
-                        requests.delete(
-                            media_url + "/{}".format(featured_image_id),
-                            headers=auth_header(),
-                        )
-                        response = requests.post(
-                            media_url,
-                            data=multipart_data,
-                            headers={"Content-Type": multipart_data.content_type},
-                            auth=(WORDPRESS_USER, WORDPRESS_APPLICATION_PASSWORD),
-                        ).json()
-                        services_table.update(
-                            service_object.id,
-                            {
-                                AIRTABLE_MAP["wp_image_id"]: str(response["id"]),
-                                AIRTABLE_MAP[
-                                    "wp_image_last_uploaded_name"
-                                ]: image_filename_from_airtable,
-                            },
-                        )
-                        resource_body["featured_media"] = response["id"]
-                    else:
-                        click.echo(
-                            click.style("In preview mode, skipping upload", fg="yellow")
-                        )
+                    if media_id:
+                        resource_body["featured_media"] = media_id
+                else:
+                    click.echo(
+                        click.style("In preview mode, skipping upload", fg="yellow")
+                    )
 
         else:
             # This featured image ID comes from a default somewhere.
@@ -186,51 +652,42 @@ def create_or_update_oos_entry(
     elif service_image:
         click.echo("No featured image ID known, uploading!")
 
-        fileName = os.path.basename(service_image)
+        media_resource_body["slug"] = service_image_filename.split(".")[0]
 
-        with open(service_image, "rb") as service_image_file:
-            media_resource_body["file"] = (
-                fileName,
-                service_image_file,
-                "image/jpg",
+        if update:
+            media_id = use_featured_image(
+                service_object,
+                services_table,
+                service_image,
+                service_image_filename,
+                service_image_digest,
+                media_resource_body,
+                queue=queue,
             )
 
-            media_resource_body["slug"] = service_object.churchsuite_image_field[0][
-                "filename"
-            ].split(".")[0]
-
-            multipart_data = MultipartEncoder(media_resource_body)
-
-            if update:
-                response = requests.post(
-                    media_url,
-                    data=multipart_data,
-                    headers={"Content-Type": multipart_data.content_type},
-                    auth=(WORDPRESS_USER, WORDPRESS_APPLICATION_PASSWORD),
-                ).json()
-                services_table.update(
-                    service_object.id,
-                    {
-                        AIRTABLE_MAP["wp_image_id"]: str(response["id"]),
-                        AIRTABLE_MAP["wp_image_last_uploaded_name"]: fileName,
-                    },
-                )
-                resource_body["featured_media"] = response["id"]
-            else:
-                click.echo(click.style("In preview mode, skipping upload", fg="yellow"))
+            if media_id:
+                resource_body["featured_media"] = media_id
+        else:
+            click.echo(click.style("In preview mode, skipping upload", fg="yellow"))
+
+    def record_oos_id(response):
+        services_table.update(
+            service_object.id, {AIRTABLE_MAP["oos_id"]: str(response["id"])}
+        )
 
     if service_object.order_of_service_id:
+        if post_matches(existing_post, resource_body):
+            click.echo(click.style("Order of Service unchanged, skipping", fg="green"))
+            return
+
         click.echo("Order of Service ID found, updating!")
 
         if update:
-            response = requests.post(
+            write(
                 url + "/{}".format(service_object.order_of_service_id),
-                headers=auth_header(),
-                json=resource_body,
-            ).json()
-            services_table.update(
-                service_object.id,
-                {AIRTABLE_MAP["oos_id"]: str(response["id"])},
+                resource_body,
+                record_oos_id,
+                queue=queue,
             )
         else:
             click.echo(click.style("In preview mode, skipping creation", fg="yellow"))
@@ -241,18 +698,19 @@ def create_or_update_oos_entry(
         resource_body["status"] = "draft"
 
         if update:
-            response = requests.post(
-                url, headers=auth_header(), json=resource_body
-            ).json()
-            print("New OOS created with ID {id}!".format(id=response["id"]))
-            services_table.update(
-                service_object.id, {AIRTABLE_MAP["oos_id"]: str(response["id"])}
-            )
+
+            def record_new_oos_id(response):
+                print("New OOS created with ID {id}!".format(id=response["id"]))
+                record_oos_id(response)
+
+            write(url, resource_body, record_new_oos_id, queue=queue)
         else:
             click.echo(click.style("In preview mode, skipping creation", fg="yellow"))
 
 
-def create_or_update_podcast_entry(service_object, services_table, update):
+def create_or_update_podcast_entry(
+    service_object, services_table, update, existing_post=None, queue=None
+):
     podcast_resource_body = {
         "title": service_object.title_string,
         "slug": service_object.slug,
@@ -260,18 +718,24 @@ def create_or_update_podcast_entry(service_object, services_table, update):
         "content": "<p>{}</p>".format(service_object.description),
     }
 
+    def record_podcast_id(response):
+        services_table.update(
+            service_object.id, {AIRTABLE_MAP["podcast_id"]: str(response["id"])}
+        )
+
     if service_object.podcast_id:
+        if post_matches(existing_post, podcast_resource_body):
+            click.echo(click.style("Podcast unchanged, skipping", fg="green"))
+            return
+
         click.echo("Podcast ID found, updating!")
 
         if update:
-            response = requests.post(
+            write(
                 podcast_url + "/{}".format(service_object.podcast_id),
-                headers=auth_header(),
-                json=podcast_resource_body,
-            ).json()
-            services_table.update(
-                service_object.id,
-                {AIRTABLE_MAP["podcast_id"]: str(response["id"])},
+                podcast_resource_body,
+                record_podcast_id,
+                queue=queue,
             )
         else:
             click.echo(click.style("In preview mode, skipping creation", fg="yellow"))
@@ -282,12 +746,13 @@ def create_or_update_podcast_entry(service_object, services_table, update):
         podcast_resource_body["status"] = "draft"
 
         if update:
-            response = requests.post(
-                podcast_url, headers=auth_header(), json=podcast_resource_body
-            ).json()
-            print("New Podcast created with ID {id}!".format(id=response["id"]))
-            services_table.update(
-                service_object.id, {"Podcast ID": str(response["id"])}
+
+            def record_new_podcast_id(response):
+                print("New Podcast created with ID {id}!".format(id=response["id"]))
+                record_podcast_id(response)
+
+            write(
+                podcast_url, podcast_resource_body, record_new_podcast_id, queue=queue
             )
         else:
             click.echo(click.style("In preview mode, skipping creation", fg="yellow"))
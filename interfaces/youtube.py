@@ -1,17 +1,63 @@
+import datetime
+import functools
+import hashlib
+import json
 import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, NotRequired, Optional, TypedDict
 
 import boto3
 import botocore
 import click
+import google.auth.transport.requests
 import google.oauth2.credentials
+import google_auth_httplib2
 import google_auth_oauthlib.flow
 import googleapiclient.discovery
+import googleapiclient.discovery_cache
 import googleapiclient.errors
+import httplib2
+from googleapiclient.http import MediaFileUpload
 
 GOOGLE_OAUTH_SCOPES = ["https://www.googleapis.com/auth/youtube.force-ssl"]
 GOOGLE_CLIENT_SECRET_FILE = "client_secret.json"
 GOOGLE_CREDENTIALS_FILE = "token.json"
 
+YOUTUBE_NONPROFIT_CATEGORY_ID = "29"
+
+PLAYLIST_INDEX_PATH = os.environ.get(
+    "YOUTUBE_PLAYLIST_INDEX_PATH", "youtube_playlists.json"
+)
+PLAYLIST_INDEX_MAX_AGE = 7 * 24 * 60 * 60
+
+# The most calls Google recommends sending in a single batch
+YOUTUBE_BATCH_SIZE = 50
+
+# What a request (or a whole batch of them) can fail with, short of a bug
+YOUTUBE_REQUEST_ERRORS = (
+    googleapiclient.errors.HttpError,
+    httplib2.HttpLib2Error,
+    OSError,
+)
+
+# What each call we make costs from our daily quota, in units
+YOUTUBE_QUOTA_COSTS = {
+    "liveBroadcasts.list": 1,
+    "videos.list": 1,
+    "playlistItems.list": 1,
+    "liveBroadcasts.insert": 50,
+    "liveBroadcasts.update": 50,
+    "liveBroadcasts.bind": 50,
+    "videos.update": 50,
+    "thumbnails.set": 50,
+    "playlistItems.insert": 50,
+}
+YOUTUBE_QUOTA_BUDGET = int(os.environ.get("YOUTUBE_QUOTA_BUDGET", 10000))
+
 AWS_S3_BUCKET_NAME = os.environ["AWS_S3_BUCKET_NAME"]
 AWS_ACCESS_KEY_ID = os.environ["AWS_ACCESS_KEY_ID"]
 AWS_SECRET = os.environ["AWS_SECRET"]
@@ -19,74 +65,126 @@ AWS_SECRET = os.environ["AWS_SECRET"]
 os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
 
 
-class Api:  # pragma: no cover
-    def __init__(self):
-        api_service_name = "youtube"
+class CredentialsProvider:
+    # Our token is kept in S3 so that it can be shared between machines. We keep the
+    # copy we downloaded last time, and only go back to S3 when we don't have one or
+    # it's expired, in case somebody else has refreshed it since.
+    def __init__(self, credentials_file=GOOGLE_CREDENTIALS_FILE, bucket=None):
+        self.credentials_file = credentials_file
+        self._bucket = bucket
 
-        api_version = "v3"
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            s3 = boto3.resource(
+                "s3",
+                aws_access_key_id=AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=AWS_SECRET,
+            )
+            self._bucket = s3.Bucket(AWS_S3_BUCKET_NAME)
 
-        creds = None
-        # The file GOOGLE_CREDENTIALS_FILE stores the user's access and refresh tokens, and is created automatically when the authorization flow completes for the first time.
+        return self._bucket
 
-        s3 = boto3.resource(
-            "s3", aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET
-        )
-        bucket = s3.Bucket(AWS_S3_BUCKET_NAME)
+    def load_local(self):
+        try:
+            return google.oauth2.credentials.Credentials.from_authorized_user_file(
+                self.credentials_file, GOOGLE_OAUTH_SCOPES
+            )
+        except (FileNotFoundError, ValueError):
+            return None
 
+    def download(self):
         try:
-            bucket.download_file(GOOGLE_CREDENTIALS_FILE, GOOGLE_CREDENTIALS_FILE)
+            self.bucket.download_file(GOOGLE_CREDENTIALS_FILE, self.credentials_file)
         except botocore.exceptions.ClientError as e:
             if e.response["Error"]["Code"] == "404":
                 click.echo(click.style("Could not find credential file", fg="red"))
+                return None
             else:
                 # Something else has gone wrong.
                 raise
-        else:
-            click.echo(click.style("Loaded credential file", fg="green"))
-            creds = google.oauth2.credentials.Credentials.from_authorized_user_file(
-                GOOGLE_CREDENTIALS_FILE, GOOGLE_OAUTH_SCOPES
-            )
 
-        # If there are no (valid) credentials available, let the user log in.
+        click.echo(click.style("Loaded credential file", fg="green"))
+        return self.load_local()
+
+    def save(self, creds):
+        with open(self.credentials_file, "w") as token:
+            token.write(creds.to_json())
+
+        # Send the new token back to S3
+        self.bucket.upload_file(self.credentials_file, GOOGLE_CREDENTIALS_FILE)
+
+    def credentials(self):
+        creds = self.load_local()
+
         if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(google.auth.transport.requests.Request())
-            else:
-                bucket.download_file(
-                    GOOGLE_CLIENT_SECRET_FILE, GOOGLE_CLIENT_SECRET_FILE
-                )
-                flow = (
-                    google_auth_oauthlib.flow.InstalledAppFlow.from_client_secrets_file(
-                        GOOGLE_CLIENT_SECRET_FILE, GOOGLE_OAUTH_SCOPES
-                    )
-                )
-                creds = flow.run_console()
-            # Save the credentials for the next run
-            with open(GOOGLE_CREDENTIALS_FILE, "w") as token:
-                token.write(creds.to_json())
+            creds = self.download() or creds
+
+        if creds and creds.valid:
+            return creds
+
+        # If there are no (valid) credentials available, let the user log in.
+        if creds and creds.expired and creds.refresh_token:
+            creds.refresh(google.auth.transport.requests.Request())
+        else:  # pragma: no cover
+            self.bucket.download_file(
+                GOOGLE_CLIENT_SECRET_FILE, GOOGLE_CLIENT_SECRET_FILE
+            )
+            flow = google_auth_oauthlib.flow.InstalledAppFlow.from_client_secrets_file(
+                GOOGLE_CLIENT_SECRET_FILE, GOOGLE_OAUTH_SCOPES
+            )
+            creds = flow.run_console()
 
-        # Send the new/updated token back to S3
-        bucket.upload_file(GOOGLE_CREDENTIALS_FILE, GOOGLE_CREDENTIALS_FILE)
+        self.save(creds)
 
-        self.client = googleapiclient.discovery.build(
-            api_service_name, api_version, credentials=creds
+        return creds
+
+
+@functools.cache
+def youtube_discovery_document():
+    # The client library ships with discovery documents, so there's no need to fetch
+    # one, and we only need to parse it once
+    return json.loads(googleapiclient.discovery_cache.get_static_doc("youtube", "v3"))
+
+
+class Api:  # pragma: no cover
+    def __init__(self, credentials_provider=None):
+        self.credentials = (credentials_provider or CredentialsProvider()).credentials()
+
+        self.client = googleapiclient.discovery.build_from_document(
+            youtube_discovery_document(), credentials=self.credentials
         )
 
+    def new_http(self):
+        # A connection of our own, for use from another thread
+        return google_auth_httplib2.AuthorizedHttp(
+            self.credentials, http=httplib2.Http()
+        )
 
-class Playlist:
-    videos_in_list: list[str] = []
 
-    def __init__(self, youtube, playlist_id):
+class Playlist:
+    def __init__(self, youtube, playlist_id, video_ids=None, quota=None):
         self.youtube = youtube
         self.playlist_id = playlist_id
+        self.quota = quota
+        self.lock = threading.Lock()
+
+        # Videos we've confirmed aren't in the list during this run
+        self.videos_not_in_list: set[str] = set()
 
-        self.load_list_items()
+        if video_ids is None:
+            self.load_list_items()
+        else:
+            self.videos_in_list = set(video_ids)
 
     def load_list_items(self, pagination_token=None):
         items_to_load = True
-        video_list = []
+        video_list = set()
 
         while items_to_load:
+            if self.quota:
+                self.quota.record("playlistItems.list")
+
             request = self.youtube.client.playlistItems().list(
                 part="snippet",
                 maxResults=50,
@@ -100,7 +198,7 @@ class Playlist:
                 resource = item["snippet"]["resourceId"]
 
                 if resource["kind"] == "youtube#video":
-                    video_list.append(resource["videoId"])
+                    video_list.add(resource["videoId"])
 
             if "nextPageToken" in response:
                 pagination_token = response["nextPageToken"]
@@ -109,27 +207,867 @@ class Playlist:
 
         self.videos_in_list = video_list
 
+    def load_video(self, video_id, http=None):
+        # Ask about just the one video, rather than paging through the whole list
+        if self.quota:
+            self.quota.record("playlistItems.list")
+
+        request = self.youtube.client.playlistItems().list(
+            part="id",
+            maxResults=1,
+            playlistId=self.playlist_id,
+            videoId=video_id,
+        )
+        response = request.execute(http=http) if http else request.execute()
+
+        return bool(response["items"])
+
+    def contains(self, video_id, http=None):
+        with self.lock:
+            if video_id in self.videos_in_list:
+                return True
+
+            if video_id in self.videos_not_in_list:
+                return False
+
+        # Our index may be out of date, so check with YouTube before saying no
+        found = self.load_video(video_id, http)
+
+        with self.lock:
+            if found:
+                self.videos_in_list.add(video_id)
+            else:
+                self.videos_not_in_list.add(video_id)
+
+        return found
+
+    def add(self, video_id):
+        with self.lock:
+            self.videos_in_list.add(video_id)
+            self.videos_not_in_list.discard(video_id)
+
     @property
     def items(self):
         return self.videos_in_list
 
 
 class PlaylistManager:
-    playlists: dict[str, Playlist] = {}
+    # Playlists by ID, backed by an index on disk so that later runs only need to ask
+    # YouTube about videos they haven't seen in a list before
+    def __init__(self, youtube=None, index_path=PLAYLIST_INDEX_PATH, quota=None):
+        self.youtube = youtube or Api()
+        self.index_path = index_path
+        self.quota = quota
+        self.playlists: dict[str, Playlist] = {}
+        self.lock = threading.Lock()
 
-    def __init__(self):
-        self.youtube = Api()
+        try:
+            with open(self.index_path) as index_file:
+                self.index = json.load(index_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.index = {}
 
     def get(self, playlist_id):
-        if playlist_id not in self.playlists:
-            self.playlists[playlist_id] = Playlist(self.youtube, playlist_id)
+        # Held while loading, so two threads never load the same playlist
+        with self.lock:
+            if playlist_id not in self.playlists:
+                entry = self.index.get(playlist_id)
+
+                # Videos can be taken out of lists by hand, so reload in full now and
+                # then
+                if entry and time.time() - entry["loaded_at"] < PLAYLIST_INDEX_MAX_AGE:
+                    self.playlists[playlist_id] = Playlist(
+                        self.youtube, playlist_id, entry["videos"], quota=self.quota
+                    )
+                else:
+                    self.playlists[playlist_id] = Playlist(
+                        self.youtube, playlist_id, quota=self.quota
+                    )
+                    self.index[playlist_id] = {"loaded_at": time.time()}
+
+            return self.playlists[playlist_id]
+
+    def known_videos(self, playlist_id):
+        # What we already know is in a list, without asking YouTube, or None if we
+        # don't know the list at all
+        with self.lock:
+            playlist = self.playlists.get(playlist_id)
+
+            if playlist:
+                with playlist.lock:
+                    return set(playlist.videos_in_list)
+
+            entry = self.index.get(playlist_id)
+
+            if entry and time.time() - entry["loaded_at"] < PLAYLIST_INDEX_MAX_AGE:
+                return set(entry.get("videos", []))
+
+            return None
+
+    def save(self):
+        with self.lock:
+            for playlist_id, playlist in self.playlists.items():
+                with playlist.lock:
+                    self.index[playlist_id]["videos"] = sorted(playlist.videos_in_list)
+
+        directory = os.path.dirname(os.path.abspath(self.index_path))
+
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, delete=False
+        ) as index_file:
+            json.dump(self.index, index_file, indent=2, sort_keys=True)
+
+        os.replace(index_file.name, self.index_path)
+
+
+_api: Optional[Api] = None
+_playlist_manager: Optional[PlaylistManager] = None
+
+
+def api():
+    # One authenticated client for the whole run
+    global _api
+
+    if _api is None:
+        _api = Api()
 
-        return self.playlists[playlist_id]
+    return _api
+
+
+def playlist_manager():
+    global _playlist_manager
+
+    if _playlist_manager is None:
+        _playlist_manager = PlaylistManager(api())
+
+    return _playlist_manager
 
 
 def video_in_playlist(video_id, playlist_id):
-    playlist = PlaylistManager().get(playlist_id)
+    playlist = playlist_manager().get(playlist_id)
 
     click.echo(click.style(f"Checking if {video_id} in {playlist_id}", fg="blue"))
 
-    return video_id in playlist.items
+    return playlist.contains(video_id)
+
+
+class YoutubeResourceBodySnippetDict(TypedDict):
+    title: str
+    description: str
+    scheduledStartTime: str
+
+
+class YoutubeResourceBodyStatusDict(TypedDict):
+    privacyStatus: str
+
+
+class YoutubeResourceBodyContentDetailsDict(TypedDict):
+    boundStreamId: NotRequired[str]
+
+
+class YoutubeResourceBodyDict(TypedDict):
+    id: NotRequired[str]
+    snippet: YoutubeResourceBodySnippetDict
+    status: YoutubeResourceBodyStatusDict
+    # Only on broadcasts fetched from YouTube, saying which stream they're bound to
+    contentDetails: NotRequired[YoutubeResourceBodyContentDetailsDict]
+
+
+def youtube_description(service):
+    if service.has_oos:
+        return (
+            service.description
+            + "\r\n\r\n"
+            + "View the order of service online at https://whitkirkchurch.org.uk/oos/{slug}".format(
+                slug=service.slug
+            )
+        )
+
+    return service.description
+
+
+def broadcast_resource_body(service, video_id=None) -> YoutubeResourceBodyDict:
+    resource_body: YoutubeResourceBodyDict = {
+        "snippet": {
+            "scheduledStartTime": service.datetime_localised.isoformat(),
+            "title": service.title_string_with_date,
+            "description": youtube_description(service),
+        },
+        "status": {
+            "privacyStatus": service.youtube_privacy,
+        },
+    }
+
+    if video_id:
+        resource_body["id"] = video_id
+
+    return resource_body
+
+
+def video_resource_body(service, video_id):
+    return {
+        "id": video_id,
+        "snippet": {
+            "categoryId": YOUTUBE_NONPROFIT_CATEGORY_ID,
+            "title": service.title_string_with_date,
+            "description": youtube_description(service),
+        },
+        "status": {
+            "privacyStatus": service.youtube_privacy,
+            "selfDeclaredMadeForKids": False,
+            "embeddable": service.youtube_is_embeddable,
+        },
+    }
+
+
+def broadcast_state_digest(service, stream_id):
+    # Everything we'd push to YouTube for a service's broadcast and video, so that we
+    # can tell when there's nothing new to send
+    broadcast_body = broadcast_resource_body(service)
+
+    video_body = video_resource_body(service, None)
+    del video_body["id"]
+
+    return hashlib.sha256(
+        json.dumps(
+            {"broadcast": broadcast_body, "video": video_body, "stream": stream_id},
+            sort_keys=True,
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+def execute_batched(client, requests, callback, batch_size=YOUTUBE_BATCH_SIZE):
+    # Send requests (keyed by a string ID) in as few round-trips as we can. The callback
+    # gets each request's ID, and either its response or the exception it raised.
+    requests = list(requests.items())
+
+    for start in range(0, len(requests), batch_size):
+        batch = client.new_batch_http_request()
+        answered = set()
+
+        def answer(request_id, response, exception):
+            answered.add(request_id)
+            callback(request_id, response, exception)
+
+        for request_id, request in requests[start : start + batch_size]:
+            batch.add(request, callback=answer, request_id=request_id)
+
+        try:
+            batch.execute()
+        except YOUTUBE_REQUEST_ERRORS as err:
+            # The whole batch failed, so pass that on for every request it didn't
+            # get to, and carry on with the next
+            for request_id, _ in requests[start : start + batch_size]:
+                if request_id not in answered:
+                    callback(request_id, None, err)
+
+
+def normalise_text(text):
+    # YouTube hands back line endings differently from how we send them
+    return (text or "").replace("\r\n", "\n").strip()
+
+
+def broadcast_differs(service, broadcast):
+    desired = broadcast_resource_body(service)
+
+    return (
+        normalise_text(broadcast["snippet"].get("title"))
+        != normalise_text(desired["snippet"]["title"])
+        or normalise_text(broadcast["snippet"].get("description"))
+        != normalise_text(desired["snippet"]["description"])
+        or datetime.datetime.fromisoformat(broadcast["snippet"]["scheduledStartTime"])
+        != datetime.datetime.fromisoformat(desired["snippet"]["scheduledStartTime"])
+        or broadcast["status"].get("privacyStatus")
+        != desired["status"]["privacyStatus"]
+    )
+
+
+def video_differs(service, video):
+    desired = video_resource_body(service, video["id"])
+
+    return (
+        video["snippet"].get("categoryId") != desired["snippet"]["categoryId"]
+        or normalise_text(video["snippet"].get("title"))
+        != normalise_text(desired["snippet"]["title"])
+        or normalise_text(video["snippet"].get("description"))
+        != normalise_text(desired["snippet"]["description"])
+        or any(
+            video["status"].get(field) != value
+            for field, value in desired["status"].items()
+        )
+    )
+
+
+BROADCAST_STAGES = frozenset({"upsert", "bind", "video"})
+
+
+class BroadcastJob:
+    def __init__(self, service, stream_id, force=False):
+        self.service = service
+        self.video_id = service.youtube_id
+        self.error = None
+        self.state_digest = broadcast_state_digest(service, stream_id)
+
+        # Broadcasts which are already live or over are left alone
+        self.finished = False
+
+        # Broadcasts we haven't the quota for this time round
+        self.deferred = False
+
+        # Broadcasts which already match what we'd send can skip straight to
+        # thumbnails and playlists
+        if (
+            force
+            or not service.youtube_id
+            or service.youtube_state_digest != self.state_digest
+        ):
+            self.stages = set(BROADCAST_STAGES)
+        else:
+            self.stages = set()
+
+    @property
+    def changed(self):
+        return bool(self.stages)
+
+    def reconcile(self, broadcast, video, stream_id, force=False):
+        # Work out which stages we need from what YouTube actually has
+        if video is None:
+            click.echo(
+                click.style(
+                    "{} no longer exists on YouTube, creating a new broadcast".format(
+                        self.video_id
+                    ),
+                    fg="yellow",
+                )
+            )
+            self.video_id = None
+            self.stages = set(BROADCAST_STAGES)
+
+        elif video["snippet"].get("liveBroadcastContent") != "upcoming":
+            self.finished = True
+            self.stages = set()
+
+        elif not force:
+            self.stages = set()
+
+            if broadcast is None or broadcast_differs(self.service, broadcast):
+                self.stages.add("upsert")
+
+            if (
+                broadcast is None
+                or broadcast.get("contentDetails", {}).get("boundStreamId") != stream_id
+            ):
+                self.stages.add("bind")
+
+            if video_differs(self.service, video):
+                self.stages.add("video")
+
+
+class QuotaLedger:
+    # Keeps count of the YouTube quota we've spent in this run, by operation
+    def __init__(self, budget=YOUTUBE_QUOTA_BUDGET):
+        self.budget = budget
+        self.calls: dict[str, int] = defaultdict(int)
+        self.units: dict[str, int] = defaultdict(int)
+        self.lock = threading.RLock()
+
+    @property
+    def used(self):
+        return sum(self.units.values())
+
+    @property
+    def remaining(self):
+        return self.budget - self.used
+
+    def record(self, operation):
+        with self.lock:
+            self.calls[operation] += 1
+            self.units[operation] += YOUTUBE_QUOTA_COSTS[operation]
+
+    def spend(self, operation):
+        # Like record, but refuses anything which would take us over budget
+        with self.lock:
+            if YOUTUBE_QUOTA_COSTS[operation] > self.remaining:
+                return False
+
+            self.record(operation)
+            return True
+
+    def report(self):
+        for operation in sorted(self.units):
+            click.echo(
+                "{operation}: {calls} calls, {units} units".format(
+                    operation=operation,
+                    calls=self.calls[operation],
+                    units=self.units[operation],
+                )
+            )
+
+        click.echo(
+            "Used {used} of {budget} quota units".format(
+                used=self.used, budget=self.budget
+            )
+        )
+
+
+STAGE_OPERATIONS = {
+    "upsert": "liveBroadcasts.update",
+    "bind": "liveBroadcasts.bind",
+    "video": "videos.update",
+}
+
+
+class BroadcastSync:
+    # Syncs a set of services with their broadcasts, one stage at a time. Each stage is
+    # sent in batches across every service, so the order of calls within a service still
+    # holds, and a service which fails at one stage is left out of the ones after it.
+    # Services are worked through in order of start time, so if we run short of quota
+    # it's the furthest-off services which wait for the next run.
+    def __init__(
+        self,
+        client,
+        stream_id,
+        services,
+        playlists=None,
+        force=False,
+        quota=None,
+        http_factory=None,
+    ):
+        self.client = client
+        self.http_factory = http_factory
+        self.thread_local = threading.local()
+        self.callback_lock = threading.Lock()
+        self.stream_id = stream_id
+        self.playlists = playlists
+        self.force = force
+        self.quota = quota or QuotaLedger()
+        self.jobs = {
+            service.id: BroadcastJob(service, stream_id, force)
+            for service in sorted(
+                services, key=lambda service: service.datetime_localised
+            )
+        }
+
+    @property
+    def pending_jobs(self):
+        return [job for job in self.jobs.values() if not job.error and not job.deferred]
+
+    @property
+    def changed_jobs(self):
+        return [job for job in self.pending_jobs if job.changed]
+
+    @property
+    def synced_jobs(self):
+        return [job for job in self.pending_jobs if not job.finished]
+
+    @property
+    def deferred_jobs(self):
+        return [job for job in self.jobs.values() if job.deferred]
+
+    def jobs_for_stage(self, stage):
+        return [job for job in self.pending_jobs if stage in job.stages]
+
+    def reconcile(self):
+        # Fetch what YouTube has for all of our broadcasts in a few list calls, and
+        # only keep the stages that would actually change something
+        jobs_by_video_id = {
+            job.video_id: job for job in self.pending_jobs if job.video_id
+        }
+        video_ids = list(jobs_by_video_id)
+        videos = {}
+        broadcasts = {}
+
+        for start in range(0, len(video_ids), YOUTUBE_BATCH_SIZE):
+            chunk = video_ids[start : start + YOUTUBE_BATCH_SIZE]
+            self.quota.record("videos.list")
+
+            try:
+                response = (
+                    self.client.videos()
+                    .list(
+                        part="snippet,status",
+                        id=",".join(chunk),
+                        maxResults=YOUTUBE_BATCH_SIZE,
+                    )
+                    .execute()
+                )
+            except YOUTUBE_REQUEST_ERRORS as err:
+                # Without the videos we can't tell what's changed, so these services
+                # go on what was last pushed
+                click.echo(
+                    click.style(
+                        "Couldn't fetch videos from YouTube: {}".format(err), fg="red"
+                    )
+                )
+
+                for video_id in chunk:
+                    del jobs_by_video_id[video_id]
+
+                continue
+
+            for item in response["items"]:
+                videos[item["id"]] = item
+
+        pagination_token = None
+
+        while jobs_by_video_id:
+            self.quota.record("liveBroadcasts.list")
+
+            try:
+                response = (
+                    self.client.liveBroadcasts()
+                    .list(
+                        part="id,snippet,status,contentDetails",
+                        broadcastStatus="upcoming",
+                        maxResults=YOUTUBE_BATCH_SIZE,
+                        pageToken=pagination_token,
+                    )
+                    .execute()
+                )
+            except YOUTUBE_REQUEST_ERRORS as err:
+                # A broadcast missing from a partial list would look like it needs
+                # pushing again, so everything goes on what was last pushed instead
+                click.echo(
+                    click.style(
+                        "Couldn't fetch broadcasts from YouTube: {}".format(err),
+                        fg="red",
+                    )
+                )
+                return
+
+            for item in response["items"]:
+                broadcasts[item["id"]] = item
+
+            if "nextPageToken" in response:
+                pagination_token = response["nextPageToken"]
+            else:
+                break
+
+        for video_id, job in jobs_by_video_id.items():
+            job.reconcile(
+                broadcasts.get(video_id),
+                videos.get(video_id),
+                self.stream_id,
+                self.force,
+            )
+
+    def estimated_cost(self, job, replacing_thumbnail=False):
+        cost = sum(YOUTUBE_QUOTA_COSTS[STAGE_OPERATIONS[stage]] for stage in job.stages)
+
+        if replacing_thumbnail:
+            cost += YOUTUBE_QUOTA_COSTS["thumbnails.set"]
+
+        for playlist_id in job.service.youtube_playlists_for_service:
+            known_videos = (
+                self.playlists.known_videos(playlist_id) if self.playlists else None
+            )
+
+            # Anything we don't already know is in the list may need a lookup and then
+            # adding, whether it's a new video or one that's been taken out by hand
+            if job.video_id and known_videos and job.video_id in known_videos:
+                continue
+
+            cost += YOUTUBE_QUOTA_COSTS["playlistItems.list"]
+            cost += YOUTUBE_QUOTA_COSTS["playlistItems.insert"]
+
+        return cost
+
+    def plan(self, thumbnail_service_ids=()):
+        # Take services in order of start time until the next one wouldn't fit in what
+        # remains of the budget, then leave it and everything after it for next time
+        planned_cost = 0
+
+        for job in self.pending_jobs:
+            cost = self.estimated_cost(job, job.service.id in thumbnail_service_ids)
+
+            if self.deferred_jobs or planned_cost + cost > self.quota.remaining:
+                job.deferred = True
+            else:
+                planned_cost += cost
+
+        return planned_cost
+
+    def within_budget(self, job, operation):
+        # Rather than run out of quota part way through a stage, defer the service
+        if self.quota.spend(operation):
+            return True
+
+        job.deferred = True
+        return False
+
+    @property
+    def errors(self):
+        return {
+            service_id: job.error for service_id, job in self.jobs.items() if job.error
+        }
+
+    def run_stage(self, requests, on_success=None):
+        def callback(request_id, response, exception):
+            job = self.jobs[request_id.split(":")[0]]
+
+            if exception is not None:
+                job.error = exception
+            elif on_success:
+                with self.callback_lock:
+                    on_success(job, response)
+
+        execute_batched(self.client, requests, callback)
+
+    def upsert_request(self, job):
+        if job.video_id:
+            if not self.within_budget(job, "liveBroadcasts.update"):
+                return None
+
+            return self.client.liveBroadcasts().update(
+                part="snippet,status",
+                body=broadcast_resource_body(job.service, job.video_id),
+            )
+
+        if not self.within_budget(job, "liveBroadcasts.insert"):
+            return None
+
+        return self.client.liveBroadcasts().insert(
+            part="snippet,status",
+            body=broadcast_resource_body(job.service),
+        )
+
+    def bind_request(self, job):
+        # Bind the liveBroadcast to our standard stream ID
+        if not self.within_budget(job, "liveBroadcasts.bind"):
+            return None
+
+        return self.client.liveBroadcasts().bind(
+            part="id",
+            id=job.video_id,
+            streamId=self.stream_id,
+        )
+
+    def video_request(self, job):
+        # Poke an update to the Video object for things the liveBroadcast won't update
+        if not self.within_budget(job, "videos.update"):
+            return None
+
+        return self.client.videos().update(
+            part="snippet,status",
+            body=video_resource_body(job.service, job.video_id),
+        )
+
+    def thumbnail_request(self, job, image_path):
+        if not self.within_budget(job, "thumbnails.set"):
+            return None
+
+        click.echo("Updating YouTube thumbnail for {}...".format(job.video_id))
+
+        return self.client.thumbnails().set(
+            videoId=job.video_id,
+            media_body=MediaFileUpload(image_path),
+        )
+
+    def playlist_requests(self, job, playlists, http=None):
+        requests = {}
+
+        for playlist_id in job.service.youtube_playlists_for_service:
+            if playlists.get(playlist_id).contains(job.video_id, http):
+                click.echo(
+                    click.style(
+                        f"{job.video_id} already in playlist {playlist_id}",
+                        fg="yellow",
+                    )
+                )
+                continue
+
+            if not self.within_budget(job, "playlistItems.insert"):
+                break
+
+            click.echo("Adding {} to playlist {}...".format(job.video_id, playlist_id))
+
+            requests[playlist_id] = self.client.playlistItems().insert(
+                part="snippet",
+                body={
+                    "snippet": {
+                        "playlistId": playlist_id,
+                        "resourceId": {
+                            "kind": "youtube#video",
+                            "videoId": job.video_id,
+                        },
+                    }
+                },
+            )
+
+        return requests
+
+    def upsert_broadcasts(
+        self, on_upserted: Optional[Callable[[BroadcastJob], None]] = None
+    ):
+        def upserted(job, response):
+            job.video_id = response["id"]
+
+            if on_upserted:
+                on_upserted(job)
+
+        requests = {}
+
+        for job in self.jobs_for_stage("upsert"):
+            request = self.upsert_request(job)
+
+            if request:
+                requests[job.service.id] = request
+
+        self.run_stage(requests, upserted)
+
+    def bind_streams(self):
+        requests = {}
+
+        for job in self.jobs_for_stage("bind"):
+            request = self.bind_request(job)
+
+            if request:
+                requests[job.service.id] = request
+
+        self.run_stage(requests)
+
+    def update_videos(
+        self, on_updated: Optional[Callable[[BroadcastJob], None]] = None
+    ):
+        # This is the last stage for a broadcast, so once it's done YouTube has
+        # everything in our state digest
+        def updated(job, response):
+            if on_updated:
+                on_updated(job)
+
+        requests = {}
+
+        for job in self.jobs_for_stage("video"):
+            request = self.video_request(job)
+
+            if request:
+                requests[job.service.id] = request
+
+        self.run_stage(requests, updated)
+
+    def set_thumbnails(
+        self,
+        image_paths: dict[str, str],
+        on_set: Optional[Callable[[BroadcastJob], None]] = None,
+    ):
+        # Media uploads can't go in a batch, so these are sent one at a time
+        for job in self.pending_jobs:
+            if job.service.id not in image_paths:
+                continue
+
+            request = self.thumbnail_request(job, image_paths[job.service.id])
+
+            if not request:
+                continue
+
+            try:
+                request.execute()
+            except googleapiclient.errors.HttpError as err:
+                job.error = err
+            else:
+                if on_set:
+                    on_set(job)
+
+    def add_to_playlists(self):
+        playlists = self.playlists or playlist_manager()
+        requests = {}
+
+        def added(job, response):
+            playlists.get(response["snippet"]["playlistId"]).add(job.video_id)
+
+        try:
+            for job in self.pending_jobs:
+                # Checking a playlist can mean asking YouTube, which may fail for just
+                # this service
+                try:
+                    job_requests = self.playlist_requests(job, playlists)
+                except googleapiclient.errors.HttpError as err:
+                    job.error = err
+                    continue
+
+                for playlist_id, request in job_requests.items():
+                    requests[f"{job.service.id}:{playlist_id}"] = request
+
+            self.run_stage(requests, added)
+        finally:
+            playlists.save()
+
+    def sync_job(self, job, image_path=None, on_upserted=None, on_thumbnail_set=None):
+        # Run every stage for one service, in order, on this thread's own connection
+        http = self.thread_http()
+        playlists = self.playlists or playlist_manager()
+
+        def execute(request):
+            if request is None:
+                # Out of quota, so the rest of this service waits for the next run
+                return None
+
+            return request.execute(http=http) if http else request.execute()
+
+        try:
+            if "upsert" in job.stages:
+                response = execute(self.upsert_request(job))
+
+                if response is None:
+                    return
+
+                job.video_id = response["id"]
+
+                if on_upserted:
+                    with self.callback_lock:
+                        on_upserted(job)
+
+            if "bind" in job.stages and execute(self.bind_request(job)) is None:
+                return
+
+            if "video" in job.stages and execute(self.video_request(job)) is None:
+                return
+
+            if image_path:
+                if execute(self.thumbnail_request(job, image_path)) is None:
+                    return
+
+                if on_thumbnail_set:
+                    with self.callback_lock:
+                        on_thumbnail_set(job)
+
+            for playlist_id, request in self.playlist_requests(
+                job, playlists, http
+            ).items():
+                execute(request)
+                playlists.get(playlist_id).add(job.video_id)
+
+        except Exception as e:
+            job.error = e
+
+    def thread_http(self):
+        # httplib2 connections can't be shared between threads, so each worker gets its
+        # own
+        if not self.http_factory:
+            return None
+
+        if not hasattr(self.thread_local, "http"):
+            self.thread_local.http = self.http_factory()
+
+        return self.thread_local.http
+
+    def run_concurrently(
+        self,
+        max_workers,
+        image_paths: dict[str, str],
+        on_upserted: Optional[Callable[[BroadcastJob], None]] = None,
+        on_thumbnail_set: Optional[Callable[[BroadcastJob], None]] = None,
+    ):
+        # Each service's calls still happen one after another, but services no longer
+        # wait for each other
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for job in self.pending_jobs:
+                executor.submit(
+                    self.sync_job,
+                    job,
+                    image_paths.get(job.service.id),
+                    on_upserted,
+                    on_thumbnail_set,
+                )
+
+        (self.playlists or playlist_manager()).save()
@@ -1,14 +1,17 @@
 import datetime
 import os
 import re
-import urllib.request
-from http.client import HTTPMessage
-from typing import Any, NotRequired, Optional, TypedDict
+from typing import TYPE_CHECKING, Any, NotRequired, Optional, TypedDict
 
 import pytz
-from pyairtable import utils
+from pyairtable import Table
 
 from interfaces import airtable
+from services.image_cache import image_cache
+
+if TYPE_CHECKING:
+    from services.snapshot import ServiceSnapshot
+    from services.write_buffer import WriteBuffer
 
 AIRTABLE_BASE_ID = os.environ["AIRTABLE_BASE_ID"]
 AIRTABLE_SERVICES_TABLE_ID = os.environ["AIRTABLE_SERVICES_TABLE_ID"]
@@ -35,6 +38,7 @@ AIRTABLE_MAP = {
     "wp_image_last_uploaded_name": "Last uploaded Wordpress image name",
     "youtube_id": "YouTube ID",
     "youtube_image_last_uploaded_name": "Last uploaded YouTube thumbnail name",
+    "youtube_state_digest": "Last pushed YouTube state",
     "cancelled": "Cancelled?",
 }
 
@@ -90,6 +94,8 @@ class AirtableObjectDict(TypedDict):
 
 
 class AirtableEntity:
+    __slots__ = ("airtable_object",)
+
     airtable_object: AirtableObjectDict
     airtable_map: airtable_field_map_dict
 
@@ -125,17 +131,54 @@ class ServiceDataDict(TypedDict):
     fee_payable: bool
 
 
+def localise_airtable_datetime(value: str) -> datetime.datetime:
+    parsed = datetime.datetime.fromisoformat(value)
+
+    if parsed.tzinfo is None:
+        parsed = TZ_GMT.localize(parsed)
+
+    return parsed.astimezone(TZ_LONDON)
+
+
 class Service(AirtableEntity):
+    # We build a lot of these, so keep them small, and work out the derived values we
+    # lean on heavily once rather than on every access.
+    __slots__ = (
+        "id",
+        "airtable_fields",
+        "category_overrides",
+        "_has_category_overrides",
+        "_datetime_localised",
+        "_date_string",
+        "_datetime_as_naive_string",
+        "_title_string",
+        "_title_string_with_date",
+    )
+
+    airtable_map = AIRTABLE_MAP
+
     category_overrides: CategoryOverridesDict
 
     def __init__(self, airtable_object: AirtableObjectDict) -> None:
         self.id = airtable_object["id"]
 
-        self.airtable_map = AIRTABLE_MAP
         self.airtable_object = airtable_object
         self.airtable_fields = airtable_object["fields"]
 
-        if self.churchsuite_category_id in CHURCHSUITE_CATEGORY_BEHAVIOUR_OVERRIDES:
+        self.clear_cached_values()
+
+    @classmethod
+    def from_records(
+        cls, airtable_objects: list[AirtableObjectDict]
+    ) -> list["Service"]:
+        return [cls(airtable_object) for airtable_object in airtable_objects]
+
+    def clear_cached_values(self) -> None:
+        self._has_category_overrides = (
+            self.churchsuite_category_id in CHURCHSUITE_CATEGORY_BEHAVIOUR_OVERRIDES
+        )
+
+        if self._has_category_overrides:
             self.category_overrides = CHURCHSUITE_CATEGORY_BEHAVIOUR_OVERRIDES[
                 self.churchsuite_category_id
             ]
@@ -143,6 +186,16 @@ class Service(AirtableEntity):
         else:
             self.category_overrides = {}
 
+        self._datetime_localised: Optional[datetime.datetime] = None
+        self._date_string: Optional[str] = None
+        self._datetime_as_naive_string: Optional[str] = None
+        self._title_string: Optional[str] = None
+        self._title_string_with_date: Optional[str] = None
+
+    def update_fields(self, fields: airtable_fields_dict) -> None:
+        self.airtable_fields.update(fields)
+        self.clear_cached_values()
+
     @property
     def datetime_field(self) -> str:
         return self.get_mapped_airtable_field("datetime")
@@ -199,15 +252,32 @@ class Service(AirtableEntity):
     def youtube_image_last_uploaded_name(self) -> str:
         return self.get_mapped_airtable_field("youtube_image_last_uploaded_name")
 
+    @property
+    def youtube_state_digest(self) -> str:
+        return self.get_mapped_airtable_field("youtube_state_digest")
+
     @property
     def datetime_localised(self) -> datetime.datetime:
-        return TZ_GMT.localize(
-            utils.datetime_from_iso_str(self.datetime_field)
-        ).astimezone(TZ_LONDON)
+        if self._datetime_localised is None:
+            self._datetime_localised = localise_airtable_datetime(self.datetime_field)
+
+        return self._datetime_localised
+
+    @property
+    def date_string(self) -> str:
+        if self._date_string is None:
+            self._date_string = self.datetime_localised.strftime("%-d %B %Y")
+
+        return self._date_string
 
     @property
     def datetime_as_naive_string(self) -> str:
-        return self.datetime_localised.strftime("%Y-%m-%d %H:%M:%S")
+        if self._datetime_as_naive_string is None:
+            self._datetime_as_naive_string = self.datetime_localised.strftime(
+                "%Y-%m-%d %H:%M:%S"
+            )
+
+        return self._datetime_as_naive_string
 
     @property
     def datetime_to_publish_order_of_service(self) -> datetime.datetime:
@@ -261,20 +331,26 @@ class Service(AirtableEntity):
 
     @property
     def title_string(self) -> str:
-        title_string = (
-            self.liturgical_name_field
-            if self.liturgical_name_field
-            else self.name_field
-        )
+        if self._title_string is None:
+            title_string = (
+                self.liturgical_name_field
+                if self.liturgical_name_field
+                else self.name_field
+            )
+
+            # This is a hack to force a capital on the first letter of the first word, but leave the rest of the string intact.
+            self._title_string = title_string[:1].upper() + title_string[1:]
 
-        # This is a hack to force a capital on the first letter of the first word, but leave the rest of the string intact.
-        return title_string[:1].upper() + title_string[1:]
+        return self._title_string
 
     @property
     def title_string_with_date(self) -> str:
-        return self.title_string + ": {date}".format(
-            date=self.datetime_localised.strftime("%-d %B %Y"),
-        )
+        if self._title_string_with_date is None:
+            self._title_string_with_date = self.title_string + ": {date}".format(
+                date=self.date_string,
+            )
+
+        return self._title_string_with_date
 
     @property
     def described_as(self) -> str:
@@ -338,12 +414,10 @@ class Service(AirtableEntity):
         # Service-specific image squashes category defaults
         if self.has_service_specific_image:
             image_data = self.churchsuite_image_field[0]
-            image_url = image_data["url"]
-            image_save_location, _ = download_service_image(
-                image_url, image_data["filename"]
-            )
 
-            return image_save_location
+            return download_service_image(
+                image_data["url"], image_data["filename"], image_data.get("id")
+            )
 
         # Category defaults squash master default image
         if self.has_category_specific_image:
@@ -367,17 +441,11 @@ class Service(AirtableEntity):
 
     @property
     def has_category_behaviour_overrides(self) -> bool:
-        if self.churchsuite_category_id in CHURCHSUITE_CATEGORY_BEHAVIOUR_OVERRIDES:
-            return True
-        return False
+        return self._has_category_overrides
 
     @property
     def category_behaviour_overrides(self) -> CategoryOverridesDict:
-        if self.has_category_behaviour_overrides:
-            return CHURCHSUITE_CATEGORY_BEHAVIOUR_OVERRIDES[
-                self.churchsuite_category_id
-            ]
-        return {}
+        return self.category_overrides
 
     @property
     def youtube_playlists_for_service(self) -> set[str]:
@@ -413,48 +481,97 @@ class Service(AirtableEntity):
             return "unlisted"
 
 
-def upcoming_streaming_services() -> list[Service]:
-    return [
-        Service(service)
-        for service in airtable.services_table().all(
-            formula="AND({"
-            + AIRTABLE_MAP["datetime"]
-            + "} >= TODAY(),{"
-            + AIRTABLE_MAP["streaming"]
-            + "} = 'Yes')",
+# Fetches upcoming services in a single scan and filters locally for each view. Writes
+# made through the repository are applied to the cached records too, so chained commands
+# see each other's changes without another scan.
+#
+# Given a snapshot, the scan is replaced by an incremental refresh of the local copy, and
+# given a write buffer, writes are held and sent to Airtable together.
+class ServiceRepository:
+    def __init__(
+        self,
+        services_table: Optional[Table] = None,
+        snapshot: Optional["ServiceSnapshot"] = None,
+        write_buffer: Optional["WriteBuffer"] = None,
+    ) -> None:
+        self.services_table = services_table or airtable.services_table()
+        self.snapshot = snapshot
+        self.write_buffer = write_buffer
+        self._upcoming_services: Optional[list[Service]] = None
+        self._services_by_id: dict[str, Service] = {}
+
+    def upcoming_records(self) -> list[AirtableObjectDict]:
+        if self.snapshot:
+            self.snapshot.refresh()
+            return self.snapshot.upcoming_records()
+
+        return self.services_table.all(
+            formula="{" + AIRTABLE_MAP["datetime"] + "} >= TODAY()",
             sort=[AIRTABLE_MAP["datetime"]],
         )
-    ]
-
-
-def upcoming_services_with_oos() -> list[Service]:
-    return [
-        Service(service)
-        for service in airtable.services_table().all(
-            formula="AND({"
-            + AIRTABLE_MAP["datetime"]
-            + "} >= TODAY(),{"
-            + AIRTABLE_MAP["has_oos"]
-            + "} = TRUE())",
-            sort=[AIRTABLE_MAP["datetime"]],
-        )
-    ]
-
-
-def upcoming_services_with_undecided_stream_status() -> list[Service]:
-    return [
-        Service(service)
-        for service in airtable.services_table().all(
-            formula="AND({"
-            + AIRTABLE_MAP["datetime"]
-            + "} >= TODAY(),{"
-            + AIRTABLE_MAP["streaming"]
-            + "} = '')",
-            sort=[AIRTABLE_MAP["datetime"]],
-        )
-    ]
+
+    def upcoming_services(self) -> list[Service]:
+        if self._upcoming_services is None:
+            self._upcoming_services = Service.from_records(self.upcoming_records())
+            self._services_by_id = {
+                service.id: service for service in self._upcoming_services
+            }
+
+        return self._upcoming_services
+
+    def streaming_services(self) -> list[Service]:
+        return [service for service in self.upcoming_services() if service.is_streaming]
+
+    def services_with_oos(self) -> list[Service]:
+        return [service for service in self.upcoming_services() if service.has_oos]
+
+    def services_with_undecided_stream_status(self) -> list[Service]:
+        return [
+            service
+            for service in self.upcoming_services()
+            if not service.streaming_field
+        ]
+
+    def invalidate(self) -> None:
+        # Anything still held back has to reach Airtable before we read it again
+        self.flush()
+
+        self._upcoming_services = None
+        self._services_by_id = {}
+
+    def update(self, record_id: str, fields: airtable_fields_dict) -> None:
+        if self.write_buffer is not None:
+            self.write_buffer.update(record_id, fields)
+        else:
+            self.services_table.update(record_id, fields)
+
+        if record_id in self._services_by_id:
+            self._services_by_id[record_id].update_fields(fields)
+
+    def flush(self) -> None:
+        if self.write_buffer is not None:
+            self.write_buffer.flush()
+
+
+def upcoming_streaming_services(
+    snapshot: Optional["ServiceSnapshot"] = None,
+) -> list[Service]:
+    return ServiceRepository(snapshot=snapshot).streaming_services()
+
+
+def upcoming_services_with_oos(
+    snapshot: Optional["ServiceSnapshot"] = None,
+) -> list[Service]:
+    return ServiceRepository(snapshot=snapshot).services_with_oos()
+
+
+def upcoming_services_with_undecided_stream_status(
+    snapshot: Optional["ServiceSnapshot"] = None,
+) -> list[Service]:
+    return ServiceRepository(snapshot=snapshot).services_with_undecided_stream_status()
 
 
-def download_service_image(url: str, filename: str) -> tuple[str, HTTPMessage]:
-    image_save_location = "images/service_specific/{}".format(filename)
-    return urllib.request.urlretrieve(url, image_save_location)
+def download_service_image(
+    url: str, filename: str, attachment_id: Optional[str] = None
+) -> str:
+    return image_cache().get(url, filename, attachment_id)
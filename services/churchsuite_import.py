@@ -0,0 +1,154 @@
+import datetime
+import os
+import urllib.parse
+from typing import Any, Iterable, TypedDict
+
+from pyairtable import Table, formulas, utils
+
+from services import AIRTABLE_MAP, AirtableObjectDict, airtable_fields_dict
+
+# Keep each lookup formula comfortably short; Airtable pages results at 100 records anyway.
+CHURCHSUITE_IDS_PER_LOOKUP = 100
+
+IMPORTED_FIELDS = [
+    AIRTABLE_MAP["name"],
+    AIRTABLE_MAP["datetime"],
+    AIRTABLE_MAP["type"],
+    AIRTABLE_MAP["churchsuite_id"],
+    AIRTABLE_MAP["churchsuite_public_identifier"],
+    AIRTABLE_MAP["churchsuite_category_id"],
+    AIRTABLE_MAP["churchsuite_image"],
+    AIRTABLE_MAP["cancelled"],
+]
+
+
+class AirtableUpdateDict(TypedDict):
+    id: str
+    fields: airtable_fields_dict
+
+
+class ImportPlan(TypedDict):
+    create: list[airtable_fields_dict]
+    update: list[AirtableUpdateDict]
+    unchanged: list[str]
+
+
+def event_data_blob(event: dict[str, Any]) -> airtable_fields_dict:
+    data_blob = {
+        AIRTABLE_MAP["name"]: event["name"],
+        AIRTABLE_MAP["datetime"]: event["datetime"].isoformat(),
+        AIRTABLE_MAP["type"]: event["category"],
+        AIRTABLE_MAP["churchsuite_id"]: str(event["id"]),
+        AIRTABLE_MAP["churchsuite_public_identifier"]: event["identifier"],
+        AIRTABLE_MAP["churchsuite_category_id"]: str(event["category_id"]),
+        AIRTABLE_MAP["cancelled"]: event["cancelled"],
+    }
+
+    if "image_url" in event:
+        data_blob[AIRTABLE_MAP["churchsuite_image"]] = [
+            utils.attachment(event["image_url"])
+        ]
+
+    return data_blob
+
+
+def attachment_filename(attachment: dict[str, Any]) -> str:
+    if attachment.get("filename"):
+        return attachment["filename"]
+
+    return os.path.basename(urllib.parse.urlparse(attachment.get("url", "")).path)
+
+
+def attachments_match(planned: list, existing: Any) -> bool:
+    if not isinstance(existing, list) or len(planned) != len(existing):
+        return False
+
+    # Airtable rehosts attachments, so the stored URL rarely matches the source URL
+    # and the filename is the best identifier we have for the original image.
+    return all(
+        planned_attachment.get("url") == existing_attachment.get("url")
+        or attachment_filename(planned_attachment)
+        == attachment_filename(existing_attachment)
+        for planned_attachment, existing_attachment in zip(planned, existing)
+    )
+
+
+def field_values_match(field: str, planned: Any, existing: Any) -> bool:
+    if isinstance(planned, list):
+        return attachments_match(planned, existing)
+
+    if isinstance(planned, bool):
+        # Airtable omits unticked checkboxes entirely
+        return planned == bool(existing)
+
+    if field == AIRTABLE_MAP["datetime"] and planned and existing:
+        # Airtable hands back UTC with a trailing Z, ChurchSuite gives a local offset
+        planned_datetime = datetime.datetime.fromisoformat(planned)
+        return planned_datetime == datetime.datetime.fromisoformat(existing)
+
+    return (planned or None) == (existing or None)
+
+
+def changed_fields(
+    data_blob: airtable_fields_dict, existing_fields: airtable_fields_dict
+) -> airtable_fields_dict:
+    return {
+        field: value
+        for field, value in data_blob.items()
+        if not field_values_match(field, value, existing_fields.get(field))
+    }
+
+
+def churchsuite_id_formula(churchsuite_ids: list[str]) -> str:
+    return formulas.OR(
+        *[
+            formulas.match({AIRTABLE_MAP["churchsuite_id"]: churchsuite_id})
+            for churchsuite_id in churchsuite_ids
+        ]
+    )
+
+
+def existing_records_by_churchsuite_id(
+    services_table: Table, churchsuite_ids: Iterable[str]
+) -> dict[str, AirtableObjectDict]:
+    churchsuite_ids = list(churchsuite_ids)
+    records: dict[str, AirtableObjectDict] = {}
+
+    for start in range(0, len(churchsuite_ids), CHURCHSUITE_IDS_PER_LOOKUP):
+        chunk = churchsuite_ids[start : start + CHURCHSUITE_IDS_PER_LOOKUP]
+
+        for record in services_table.all(
+            formula=churchsuite_id_formula(chunk), fields=IMPORTED_FIELDS
+        ):
+            churchsuite_id = record["fields"].get(AIRTABLE_MAP["churchsuite_id"])
+
+            # If an event has somehow been duplicated, stick with the first match
+            if churchsuite_id and churchsuite_id not in records:
+                records[churchsuite_id] = record
+
+    return records
+
+
+def plan_import(
+    events_to_sync: dict[str, dict[str, Any]],
+    existing_records: dict[str, AirtableObjectDict],
+) -> ImportPlan:
+    plan: ImportPlan = {"create": [], "update": [], "unchanged": []}
+
+    for event_sync_identifier, event in events_to_sync.items():
+        data_blob = event_data_blob(event)
+
+        if event_sync_identifier in existing_records:
+            existing_record = existing_records[event_sync_identifier]
+            fields_to_update = changed_fields(data_blob, existing_record["fields"])
+
+            if fields_to_update:
+                plan["update"].append(
+                    {"id": existing_record["id"], "fields": fields_to_update}
+                )
+            else:
+                plan["unchanged"].append(existing_record["id"])
+        else:
+            plan["create"].append(data_blob)
+
+    return plan
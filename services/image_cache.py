@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import NotRequired, Optional, TypedDict
+
+import requests
+
+from interfaces import http
+
+IMAGE_CACHE_DIRECTORY = "images/service_specific"
+IMAGE_CACHE_INDEX_FILENAME = "index.json"
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", 250 * 1024 * 1024))
+
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class CachedImageDict(TypedDict):
+    path: str
+    digest: str
+    filename: str
+    size: int
+    last_used: float
+    etag: NotRequired[str]
+    last_modified: NotRequired[str]
+
+
+class ImageCache:
+    # Service images, stored by content digest and indexed by Airtable attachment ID
+    # (or URL, where there isn't one). Each image is fetched at most once per run, and
+    # across runs we only ask the origin whether it has changed.
+    def __init__(
+        self,
+        directory: str = IMAGE_CACHE_DIRECTORY,
+        max_bytes: int = IMAGE_CACHE_MAX_BYTES,
+        session: Optional[requests.Session] = None,
+    ) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.session = session or http.Session()
+        self.index_path = os.path.join(directory, IMAGE_CACHE_INDEX_FILENAME)
+        self.fetched_this_run: set[str] = set()
+        self.lock = threading.RLock()
+
+        try:
+            with open(self.index_path) as index_file:
+                self.entries: dict[str, CachedImageDict] = json.load(index_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.entries = {}
+
+    def get(self, url: str, filename: str, attachment_id: Optional[str] = None) -> str:
+        key = attachment_id or url
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry and not os.path.exists(entry["path"]):
+                entry = None
+
+            if entry and key in self.fetched_this_run:
+                entry["last_used"] = time.time()
+                return entry["path"]
+
+            entry = self.fetch(url, filename, entry)
+
+            self.entries[key] = entry
+            self.fetched_this_run.add(key)
+            self.evict()
+            self.save()
+
+            return entry["path"]
+
+    def fetch(
+        self, url: str, filename: str, entry: Optional[CachedImageDict]
+    ) -> CachedImageDict:
+        headers = {}
+
+        if entry:
+            if "etag" in entry:
+                headers["If-None-Match"] = entry["etag"]
+            if "last_modified" in entry:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        with self.session.get(
+            url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT
+        ) as response:
+            if entry and response.status_code == 304:
+                entry["last_used"] = time.time()
+                return entry
+
+            response.raise_for_status()
+
+            digest = hashlib.sha256()
+            size = 0
+
+            with tempfile.NamedTemporaryFile(
+                dir=self.directory, delete=False
+            ) as temporary_file:
+                try:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        digest.update(chunk)
+                        temporary_file.write(chunk)
+                        size += len(chunk)
+                except Exception:
+                    os.remove(temporary_file.name)
+                    raise
+
+            _, extension = os.path.splitext(filename)
+            path = os.path.join(
+                self.directory, digest.hexdigest() + (extension.lower() or ".jpg")
+            )
+
+            # Identical bytes under another key are already on disk, so share them
+            if os.path.exists(path):
+                os.remove(temporary_file.name)
+            else:
+                os.replace(temporary_file.name, path)
+
+            new_entry: CachedImageDict = {
+                "path": path,
+                "digest": digest.hexdigest(),
+                "filename": filename,
+                "size": size,
+                "last_used": time.time(),
+            }
+
+            if "ETag" in response.headers:
+                new_entry["etag"] = response.headers["ETag"]
+            if "Last-Modified" in response.headers:
+                new_entry["last_modified"] = response.headers["Last-Modified"]
+
+            return new_entry
+
+    def evict(self) -> None:
+        sizes_by_path = {
+            entry["path"]: entry["size"] for entry in self.entries.values()
+        }
+        total_size = sum(sizes_by_path.values())
+
+        for key, entry in sorted(
+            self.entries.items(), key=lambda item: item[1]["last_used"]
+        ):
+            if total_size <= self.max_bytes:
+                break
+
+            # Never throw away something we're using in this run
+            if key in self.fetched_this_run:
+                continue
+
+            del self.entries[key]
+
+            if not any(
+                other["path"] == entry["path"] for other in self.entries.values()
+            ):
+                total_size -= sizes_by_path[entry["path"]]
+                self.remove_file(entry["path"])
+
+        # Tidy up anything on disk we're no longer tracking
+        tracked_paths = {entry["path"] for entry in self.entries.values()}
+
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+
+            if (
+                filename not in {IMAGE_CACHE_INDEX_FILENAME, ".gitkeep"}
+                and not filename.startswith("tmp")
+                and path not in tracked_paths
+            ):
+                self.remove_file(path)
+
+    def remove_file(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def save(self) -> None:
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.directory, delete=False
+        ) as temporary_file:
+            json.dump(self.entries, temporary_file, indent=2, sort_keys=True)
+
+        os.replace(temporary_file.name, self.index_path)
+
+
+_image_cache: Optional[ImageCache] = None
+
+
+def image_cache() -> ImageCache:
+    global _image_cache
+
+    if _image_cache is None:
+        _image_cache = ImageCache()
+
+    return _image_cache
@@ -0,0 +1,160 @@
+import datetime
+import json
+import os
+import sqlite3
+from typing import Optional, TypedDict
+
+from pyairtable import Table
+
+from services import AIRTABLE_MAP, AirtableObjectDict
+
+SNAPSHOT_PATH = os.environ.get("AIRTABLE_SNAPSHOT_PATH", "services_snapshot.sqlite3")
+
+# Allow for clock skew between us and Airtable; re-fetching a few records is harmless
+WATERMARK_SAFETY_MARGIN = datetime.timedelta(minutes=5)
+
+# Deleted records never show up in a delta query, so periodically start from scratch
+FULL_RESYNC_INTERVAL = datetime.timedelta(days=1)
+
+AIRTABLE_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.000Z"
+
+
+class SnapshotRefreshDict(TypedDict):
+    full: bool
+    fetched: int
+    deleted: int
+
+
+def utc_now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class ServiceSnapshot:
+    def __init__(self, services_table: Table, path: str = SNAPSHOT_PATH) -> None:
+        self.services_table = services_table
+        self.connection = sqlite3.connect(path)
+        self.full_resync_requested = False
+
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS records "
+                "(id TEXT PRIMARY KEY, datetime TEXT, fields TEXT NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS records_datetime ON records (datetime)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+        )
+
+    @property
+    def watermark(self) -> Optional[datetime.datetime]:
+        value = self.get_meta("watermark")
+        return datetime.datetime.fromisoformat(value) if value else None
+
+    @property
+    def last_full_sync(self) -> Optional[datetime.datetime]:
+        value = self.get_meta("last_full_sync")
+        return datetime.datetime.fromisoformat(value) if value else None
+
+    def request_full_resync(self) -> None:
+        self.full_resync_requested = True
+
+    def needs_full_resync(self, now: datetime.datetime) -> bool:
+        last_full_sync = self.last_full_sync
+        return (
+            self.full_resync_requested
+            or self.watermark is None
+            or last_full_sync is None
+            or now - last_full_sync > FULL_RESYNC_INTERVAL
+        )
+
+    def store_records(self, records: list[AirtableObjectDict]) -> None:
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO records (id, datetime, fields) VALUES (?, ?, ?)",
+            [
+                (
+                    record["id"],
+                    record["fields"].get(AIRTABLE_MAP["datetime"]),
+                    json.dumps(record["fields"]),
+                )
+                for record in records
+            ],
+        )
+
+    def refresh(self, full: bool = False) -> SnapshotRefreshDict:
+        sync_started = utc_now()
+        full = full or self.needs_full_resync(sync_started)
+        deleted = 0
+
+        if full:
+            # Only upcoming services are worth having in full; for everything else we
+            # just need to know it still exists
+            existing_ids = {
+                record["id"]
+                for record in self.services_table.all(fields=[AIRTABLE_MAP["datetime"]])
+            }
+            records = self.services_table.all(
+                formula="{" + AIRTABLE_MAP["datetime"] + "} >= TODAY()"
+            )
+
+            with self.connection:
+                known_ids = {
+                    row[0] for row in self.connection.execute("SELECT id FROM records")
+                }
+                deleted_ids = known_ids - existing_ids
+                deleted = len(deleted_ids)
+
+                self.connection.executemany(
+                    "DELETE FROM records WHERE id = ?",
+                    [(record_id,) for record_id in deleted_ids],
+                )
+                self.store_records(records)
+                self.set_meta("last_full_sync", sync_started.isoformat())
+                self.set_meta("watermark", sync_started.isoformat())
+
+            self.full_resync_requested = False
+
+        else:
+            watermark = self.watermark
+            assert watermark is not None
+
+            records = self.services_table.all(
+                formula="IS_AFTER(LAST_MODIFIED_TIME(), DATETIME_PARSE('{}'))".format(
+                    (watermark - WATERMARK_SAFETY_MARGIN).strftime(
+                        AIRTABLE_DATETIME_FORMAT
+                    )
+                )
+            )
+
+            with self.connection:
+                self.store_records(records)
+                self.set_meta("watermark", sync_started.isoformat())
+
+        return {"full": full, "fetched": len(records), "deleted": deleted}
+
+    def upcoming_records(self) -> list[AirtableObjectDict]:
+        # Match Airtable's TODAY(), which works in UTC
+        start_of_today = utc_now().strftime("%Y-%m-%dT00:00:00.000Z")
+
+        return [
+            {"id": record_id, "fields": json.loads(fields)}
+            for record_id, fields in self.connection.execute(
+                "SELECT id, fields FROM records WHERE datetime >= ? ORDER BY datetime",
+                (start_of_today,),
+            )
+        ]
+
+    def close(self) -> None:
+        self.connection.close()
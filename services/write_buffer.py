@@ -0,0 +1,173 @@
+import json
+import os
+import threading
+from typing import Any, Optional
+
+import click
+import requests
+from pyairtable import Table
+
+WRITE_JOURNAL_PATH = os.environ.get(
+    "AIRTABLE_WRITE_JOURNAL_PATH", "airtable_writes.jsonl"
+)
+
+# Updates Airtable won't ever accept are kept here, for someone to look at
+REJECTED_WRITES_PATH = os.environ.get(
+    "AIRTABLE_REJECTED_WRITES_PATH", "airtable_writes.rejected.jsonl"
+)
+
+# Records to hold on to before sending them anyway
+WRITE_BUFFER_SIZE = 50
+
+# The most records Airtable will update in one request
+AIRTABLE_BATCH_SIZE = 10
+
+
+def is_rejection(error: requests.HTTPError) -> bool:
+    # Anything but a rate limit is Airtable saying no, rather than not now
+    status = error.response.status_code if error.response is not None else None
+    return status is not None and 400 <= status < 500 and status != 429
+
+
+class WriteBuffer:
+    # Holds field updates, merged per record, until there are enough to send in
+    # batches. Every update goes into a journal on disk first, so if we never get as
+    # far as sending it (the IDs of things we've just created, say), the next run does.
+    def __init__(
+        self,
+        services_table: Table,
+        journal_path: str = WRITE_JOURNAL_PATH,
+        max_records: int = WRITE_BUFFER_SIZE,
+        rejected_path: str = REJECTED_WRITES_PATH,
+    ) -> None:
+        self.services_table = services_table
+        self.journal_path = journal_path
+        self.rejected_path = rejected_path
+        self.max_records = max_records
+        self.pending: dict[str, dict[str, Any]] = {}
+        self.lock = threading.RLock()
+
+        for record_id, fields in self.read_journal():
+            self.pending.setdefault(record_id, {}).update(fields)
+
+        self.journal: Optional[Any] = open(journal_path, "a")
+
+        # Anything left by a run that didn't finish has to be in Airtable before we
+        # read from it, or we'd go on to create the same things again
+        if self.pending:
+            try:
+                self.flush()
+            except Exception:
+                self.journal.close()
+                raise
+
+    def read_journal(self) -> list[tuple[str, dict[str, Any]]]:
+        entries = []
+
+        try:
+            with open(self.journal_path) as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Only the last line can be half-written, and if it is, the
+                        # update it held was never sent either
+                        break
+
+                    entries.append((entry["id"], entry["fields"]))
+        except FileNotFoundError:
+            pass
+
+        return entries
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def update(self, record_id: str, fields: dict[str, Any]) -> None:
+        with self.lock:
+            if self.journal is None:
+                raise ValueError("Write buffer is closed")
+
+            self.journal.write(json.dumps({"id": record_id, "fields": fields}) + "\n")
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+            self.pending.setdefault(record_id, {}).update(fields)
+
+            if len(self.pending) >= self.max_records:
+                self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            records: list[dict[str, Any]] = [
+                {"id": record_id, "fields": fields}
+                for record_id, fields in self.pending.items()
+            ]
+
+            try:
+                for start in range(0, len(records), AIRTABLE_BATCH_SIZE):
+                    batch = records[start : start + AIRTABLE_BATCH_SIZE]
+
+                    try:
+                        self.services_table.batch_update(batch)
+                    except requests.HTTPError as e:
+                        if not is_rejection(e):
+                            raise
+
+                        # One bad record fails the whole batch, so find out which
+                        self.send_singly(batch)
+                        continue
+
+                    for record in batch:
+                        del self.pending[record["id"]]
+            finally:
+                self.rewrite_journal()
+
+    def send_singly(self, records: list[dict[str, Any]]) -> None:
+        for record in records:
+            try:
+                self.services_table.update(record["id"], record["fields"])
+            except requests.HTTPError as e:
+                if not is_rejection(e):
+                    raise
+
+                self.reject(record, e)
+
+            del self.pending[record["id"]]
+
+    def reject(self, record: dict[str, Any], error: requests.HTTPError) -> None:
+        # Airtable will never take this one (the record's gone, or a field has been
+        # renamed), so set it aside rather than have it hold up every run after
+        click.echo(
+            click.style(
+                "Airtable rejected an update to {id}, saved to {path}: {error}".format(
+                    id=record["id"], path=self.rejected_path, error=error
+                ),
+                fg="red",
+            )
+        )
+
+        with open(self.rejected_path, "a") as rejected:
+            rejected.write(json.dumps(record) + "\n")
+
+    def rewrite_journal(self) -> None:
+        # Leave just what hasn't reached Airtable yet
+        if self.journal is None:
+            return
+
+        self.journal.truncate(0)
+
+        for record_id, fields in self.pending.items():
+            self.journal.write(json.dumps({"id": record_id, "fields": fields}) + "\n")
+
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def close(self) -> None:
+        with self.lock:
+            try:
+                self.flush()
+            finally:
+                if self.journal is not None:
+                    self.journal.close()
+                    self.journal = None
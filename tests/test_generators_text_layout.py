@@ -0,0 +1,57 @@
+from generators.text_layout import MEASURING_DRAW, word_width, wrap_text
+from generators.youtube_thumbnails import FONT_LATO_BOLD_LG
+
+ORIGIN = (30, 620)
+
+
+def test_short_text_stays_on_one_line() -> None:
+    layout = wrap_text("Choral Evensong", FONT_LATO_BOLD_LG, 1130, ORIGIN)
+
+    assert layout.lines == ("Choral Evensong",)
+    assert layout.text == "Choral Evensong"
+
+
+def test_long_text_wraps_within_width() -> None:
+    layout = wrap_text(
+        "Test Service with an unusually long title designed to test multi-line behaviour",
+        FONT_LATO_BOLD_LG,
+        1130,
+        ORIGIN,
+    )
+
+    assert len(layout.lines) == 2
+    assert " ".join(layout.lines) == (
+        "Test Service with an unusually long title designed to test multi-line behaviour"
+    )
+
+    for line in layout.lines:
+        assert ORIGIN[0] + FONT_LATO_BOLD_LG.getlength(line) <= 1130
+
+
+def test_bounding_box_matches_measured_text() -> None:
+    layout = wrap_text(
+        "A very long service title which will need to wrap over more than one line",
+        FONT_LATO_BOLD_LG,
+        600,
+        ORIGIN,
+    )
+
+    assert layout.bbox == MEASURING_DRAW.multiline_textbbox(
+        ORIGIN, layout.text, anchor="ld", font=FONT_LATO_BOLD_LG
+    )
+
+
+def test_overlong_word_does_not_leave_an_empty_line() -> None:
+    layout = wrap_text("Supercalifragilistic", FONT_LATO_BOLD_LG, 100, ORIGIN)
+
+    assert layout.lines == ("Supercalifragilistic",)
+
+
+def test_word_widths_are_memoised_per_font() -> None:
+    word_width.cache_clear()
+
+    wrap_text("Choral Evensong for Advent", FONT_LATO_BOLD_LG, 1130, (0, 0))
+    wrap_text("Choral Evensong for Epiphany", FONT_LATO_BOLD_LG, 1130, (0, 0))
+
+    # "Choral", "Evensong", "for" and the space are measured once and then reused
+    assert word_width.cache_info().hits >= 4
@@ -1,9 +1,18 @@
 import os
+import shutil
+import tempfile
 from unittest.mock import patch
 
 from factories import serviceFactory
-
-from generators.youtube_thumbnails import YoutubeThumbnail
+from PIL import Image
+
+from generators import youtube_thumbnails
+from generators.youtube_thumbnails import (
+    TARGET_THUMBNAIL_DIMENSIONS,
+    YoutubeThumbnail,
+    compose_thumbnail,
+    generate_thumbnails,
+)
 from services import AIRTABLE_MAP
 
 
@@ -29,7 +38,7 @@ def test_generated_image_hash() -> None:
     )
     youtube_thumbnail = YoutubeThumbnail(service)
 
-    assert youtube_thumbnail.generated_image_hash == "98e95ba1746fb2c670edbb639d50c585"
+    assert youtube_thumbnail.generated_image_hash == "1c7bb176c8f992044804e01cbc9af904"
 
 
 @patch(
@@ -47,7 +56,7 @@ def test_generated_image_path() -> None:
 
     assert (
         youtube_thumbnail.generated_image_path
-        == "images/youtube_generated_thumbnails/98e95ba1746fb2c670edbb639d50c585.jpg"
+        == "images/youtube_generated_thumbnails/1c7bb176c8f992044804e01cbc9af904.jpg"
     )
 
 
@@ -67,7 +76,7 @@ def test_generate_saves_image_with_single_line_title() -> None:
     youtube_thumbnail.generate()
 
     assert os.path.isfile(
-        "images/youtube_generated_thumbnails/98e95ba1746fb2c670edbb639d50c585.jpg"
+        "images/youtube_generated_thumbnails/1c7bb176c8f992044804e01cbc9af904.jpg"
     )
 
 
@@ -89,5 +98,119 @@ def test_generate_saves_image_with_multi_line_title() -> None:
     youtube_thumbnail.generate()
 
     assert os.path.isfile(
-        "images/youtube_generated_thumbnails/c55ed34a5c26be1fa6723d7afdb1a036.jpg"
+        "images/youtube_generated_thumbnails/a71e1cfb9877f2ad77f13c48c34a096f.jpg"
+    )
+
+
+def test_generated_image_hash_follows_image_content() -> None:
+    service = serviceFactory(
+        {
+            AIRTABLE_MAP["name"]: "Test Service",
+            AIRTABLE_MAP["datetime"]: "2022-01-01T10:00:00.000Z",
+        }
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        first_copy = os.path.join(directory, "first.jpg")
+        second_copy = os.path.join(directory, "second.jpg")
+        shutil.copy("images/default_thumbnails/service.jpg", first_copy)
+        shutil.copy("images/default_thumbnails/service.jpg", second_copy)
+
+        with patch.object(YoutubeThumbnail, "service_image_path", first_copy):
+            first_hash = YoutubeThumbnail(service).generated_image_hash
+
+        with patch.object(YoutubeThumbnail, "service_image_path", second_copy):
+            second_hash = YoutubeThumbnail(service).generated_image_hash
+
+        shutil.copy("images/default_thumbnails/evensong.jpg", second_copy)
+
+        with patch.object(YoutubeThumbnail, "service_image_path", second_copy):
+            changed_hash = YoutubeThumbnail(service).generated_image_hash
+
+    assert first_hash == second_hash
+    assert first_hash != changed_hash
+
+
+@patch("generators.youtube_thumbnails.render_thumbnail")
+def test_generate_reuses_existing_output(render_thumbnail) -> None:
+    youtube_thumbnail = YoutubeThumbnail(
+        serviceFactory(
+            {
+                AIRTABLE_MAP["name"]: "Test Service",
+                AIRTABLE_MAP["datetime"]: "2022-01-01T10:00:00.000Z",
+            }
+        )
+    )
+
+    with patch.object(YoutubeThumbnail, "is_generated", True):
+        youtube_thumbnail.generate()
+        assert generate_thumbnails([youtube_thumbnail]) == {}
+
+    render_thumbnail.assert_not_called()
+
+
+class MissingImageThumbnail(YoutubeThumbnail):
+    @property
+    def service_image_path(self):
+        return "images/does-not-exist.jpg"
+
+
+def test_generate_thumbnails_renders_batch_and_isolates_errors() -> None:
+    thumbnails = [
+        YoutubeThumbnail(
+            serviceFactory(
+                {
+                    AIRTABLE_MAP["name"]: "Batch Service {}".format(index),
+                    AIRTABLE_MAP["datetime"]: "2022-01-01T10:00:00.000Z",
+                },
+                id="recBaTcH{}".format(index),
+            )
+        )
+        for index in range(3)
+    ]
+
+    broken_thumbnail = MissingImageThumbnail(
+        serviceFactory(
+            {
+                AIRTABLE_MAP["name"]: "Broken Service",
+                AIRTABLE_MAP["datetime"]: "2022-01-01T10:00:00.000Z",
+            },
+            id="recBrOkEn",
+        )
     )
+
+    errors = generate_thumbnails(thumbnails + [broken_thumbnail], max_workers=2)
+
+    assert list(errors) == ["recBrOkEn"]
+
+    for thumbnail in thumbnails:
+        assert os.path.isfile(thumbnail.generated_image_path)
+
+
+def test_compose_thumbnail_reuses_prepared_background() -> None:
+    with patch.dict(youtube_thumbnails._backgrounds, clear=True), patch(
+        "generators.youtube_thumbnails.prepare_background",
+        wraps=youtube_thumbnails.prepare_background,
+    ) as prepare_background:
+        first = compose_thumbnail(
+            "images/default_thumbnails/service.jpg", "First Service", "1 January 2022"
+        )
+        second = compose_thumbnail(
+            "images/default_thumbnails/service.jpg", "Second Service", "1 January 2022"
+        )
+
+    prepare_background.assert_called_once()
+    assert first.tobytes() != second.tobytes()
+
+
+def test_compose_thumbnail_downscales_large_sources() -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        source_path = os.path.join(directory, "large.jpg")
+
+        with Image.open("images/default_thumbnails/service.jpg") as image:
+            image.resize((3840, 2160)).save(source_path, format="JPEG")
+
+        with patch.dict(youtube_thumbnails._backgrounds, clear=True):
+            thumbnail = compose_thumbnail(source_path, "Test Service", "1 January 2022")
+
+    assert thumbnail.size == TARGET_THUMBNAIL_DIMENSIONS
@@ -0,0 +1,170 @@
+import logging
+import os
+import time
+import weakref
+from unittest.mock import patch
+
+import pytest
+from PIL import Image, ImageChops, ImageDraw, ImageFilter, ImageStat
+
+from generators import youtube_thumbnails
+from generators.text_layout import word_width, wrap_text
+from generators.youtube_thumbnails import (
+    BOTTOM_MARGIN,
+    FONT_LATO_BOLD_LG,
+    FONT_LATO_REGULAR_MD,
+    LEFT_MARGIN,
+    RIGHT_MARGIN,
+    SPACING_BETWEEN_TEXT,
+    TARGET_THUMBNAIL_DIMENSIONS,
+    compose_thumbnail,
+)
+
+SOURCE_PATH = "images/default_thumbnails/service.jpg"
+TITLE = (
+    "Test Service with an unusually long title designed to test multi-line behaviour"
+)
+DATE = "1 January 2022"
+
+RENDER_COUNT = 5
+
+# Timings are only worth having on a quiet machine, so they're opt-in
+RUN_BENCHMARKS = bool(os.environ.get("RUN_BENCHMARKS"))
+
+logger = logging.getLogger(__name__)
+
+
+def legacy_compose_thumbnail(source_path, title, date):
+    # The renderer as it was: a full-frame RGBA shadow layer, blurred in its entirety,
+    # with the text drawn a second time for the sharp layer
+    with Image.open(source_path) as thumb_image:
+        thumb_image.thumbnail(TARGET_THUMBNAIL_DIMENSIONS)
+        sized_image = thumb_image.resize(TARGET_THUMBNAIL_DIMENSIONS)
+
+        blurred = Image.new("RGBA", sized_image.size)
+        draw = ImageDraw.Draw(blurred)
+
+        main_text_draw_coordinates = (
+            LEFT_MARGIN,
+            TARGET_THUMBNAIL_DIMENSIONS[1] - 10 - BOTTOM_MARGIN,
+        )
+        main_text_layout = wrap_text(
+            title,
+            FONT_LATO_BOLD_LG,
+            TARGET_THUMBNAIL_DIMENSIONS[0] - LEFT_MARGIN - RIGHT_MARGIN,
+            main_text_draw_coordinates,
+        )
+        main_text = main_text_layout.text
+        aux_text_draw_coordinates = (
+            LEFT_MARGIN,
+            main_text_layout.bbox[1] - SPACING_BETWEEN_TEXT,
+        )
+
+        draw.multiline_text(
+            xy=main_text_draw_coordinates,
+            text=main_text,
+            fill="#030303",
+            font=FONT_LATO_BOLD_LG,
+            anchor="ld",
+        )
+        draw.text(
+            xy=aux_text_draw_coordinates,
+            text=date,
+            fill="#030303",
+            font=FONT_LATO_REGULAR_MD,
+            anchor="ld",
+        )
+        blurred = blurred.filter(ImageFilter.BoxBlur(7))
+
+        sized_image.paste(blurred, blurred)
+
+        draw = ImageDraw.Draw(sized_image)
+        draw.text(
+            xy=main_text_draw_coordinates,
+            text=main_text,
+            fill="#FFF",
+            font=FONT_LATO_BOLD_LG,
+            anchor="ld",
+        )
+        draw.text(
+            xy=aux_text_draw_coordinates,
+            text=date,
+            fill="#FFF",
+            font=FONT_LATO_REGULAR_MD,
+            anchor="ld",
+        )
+
+        return sized_image
+
+
+def image_bytes(image) -> int:
+    # Pillow keeps multi-band images at four bytes a pixel internally
+    return image.width * image.height * (1 if len(image.getbands()) == 1 else 4)
+
+
+def clear_caches() -> None:
+    # Start every render cold, so we measure drawing the thumbnail rather than
+    # reusing a prepared background or a remembered layout
+    youtube_thumbnails._backgrounds.clear()
+    wrap_text.cache_clear()
+    word_width.cache_clear()
+
+
+def measure(compose) -> tuple[float, int]:
+    # Time a handful of renders, and track the peak memory held by live images
+    live = {"bytes": 0, "peak": 0}
+    original_new = Image.Image._new
+
+    def release(size):
+        live["bytes"] -= size
+
+    def tracked_new(self, im):
+        image = original_new(self, im)
+        size = image_bytes(image)
+
+        live["bytes"] += size
+        live["peak"] = max(live["peak"], live["bytes"])
+        weakref.finalize(image, release, size)
+
+        return image
+
+    elapsed = 0.0
+
+    for _ in range(RENDER_COUNT):
+        clear_caches()
+
+        started = time.perf_counter()
+        compose(SOURCE_PATH, TITLE, DATE)
+        elapsed += time.perf_counter() - started
+
+    clear_caches()
+
+    with patch.object(Image.Image, "_new", tracked_new):
+        compose(SOURCE_PATH, TITLE, DATE)
+
+    return elapsed / RENDER_COUNT, live["peak"]
+
+
+def test_composed_thumbnail_matches_legacy_renderer() -> None:
+    current = compose_thumbnail(SOURCE_PATH, TITLE, DATE)
+    legacy = legacy_compose_thumbnail(SOURCE_PATH, TITLE, DATE)
+
+    difference = ImageChops.difference(current, legacy)
+
+    # A few levels of difference in the shadow colour are fine, but nothing visible
+    assert max(high for _, high in ImageStat.Stat(difference).extrema) <= 4
+    assert max(ImageStat.Stat(difference).mean) < 0.1
+
+
+@pytest.mark.skipif(not RUN_BENCHMARKS, reason="set RUN_BENCHMARKS to run benchmarks")
+def test_composed_thumbnail_cost() -> None:
+    legacy_time, legacy_peak = measure(legacy_compose_thumbnail)
+    current_time, current_peak = measure(compose_thumbnail)
+
+    logger.warning(
+        "Per thumbnail: %.1fms and %.1fMB of images before, %.1fms and %.1fMB after",
+        legacy_time * 1e3,
+        legacy_peak / 1e6,
+        current_time * 1e3,
+        current_peak / 1e6,
+    )
@@ -0,0 +1,149 @@
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import patch
+
+import requests
+
+from interfaces import airtable, http
+
+
+class RateLimitedHandler(BaseHTTPRequestHandler):
+    # Turns away as many requests as the server has been told to, then accepts them
+    def respond(self):
+        self.server.requests.append(self.command)
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+
+        status = 200
+
+        if self.server.rate_limited:
+            self.server.rate_limited -= 1
+            status = 429
+
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_GET = respond
+    do_PATCH = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class RateLimitedServer(HTTPServer):
+    requests: list[str]
+    rate_limited: int
+
+
+class testRateLimiter(unittest.TestCase):
+    def setUp(self) -> None:
+        self.now = 100.0
+        self.slept: list[float] = []
+
+        def sleep(seconds):
+            self.slept.append(seconds)
+
+        for target, value in (
+            ("time.monotonic", lambda: self.now),
+            ("time.sleep", sleep),
+        ):
+            patcher = patch("interfaces.airtable." + target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_requests_are_spaced_out(self) -> None:
+        limiter = airtable.RateLimiter(rate=5, burst=1)
+
+        waits = [limiter.acquire() for _ in range(3)]
+
+        self.assertEqual(waits, [0.0, 0.2, 0.4])
+
+    def test_tokens_build_back_up(self) -> None:
+        limiter = airtable.RateLimiter(rate=5, burst=1)
+        limiter.acquire()
+
+        self.now += 1
+
+        self.assertEqual(limiter.acquire(), 0.0)
+
+    def test_pause_holds_everyone_back(self) -> None:
+        limiter = airtable.RateLimiter(rate=5, burst=1)
+        limiter.pause(30)
+
+        self.assertAlmostEqual(limiter.acquire(), 30.2)
+
+
+class testAirtableSession(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = RateLimitedServer(("127.0.0.1", 0), RateLimitedHandler)
+        self.server.requests = []
+        self.server.rate_limited = 0
+        self.url = "http://127.0.0.1:{}/".format(self.server.server_port)
+
+        self.thread = threading.Thread(
+            target=self.server.serve_forever,
+            kwargs={"poll_interval": 0.01},
+            daemon=True,
+        )
+        self.thread.start()
+
+        self.session = airtable.Session(airtable.RateLimiter(rate=1000, burst=10))
+
+    def tearDown(self) -> None:
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_rate_limited_requests_are_retried(self) -> None:
+        self.server.rate_limited = 2
+
+        response = self.session.patch(self.url, json={})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.session.requests_made, 3)
+        self.assertEqual(self.session.rate_limited, 2)
+
+    def test_gives_up_after_too_many_rate_limits(self) -> None:
+        self.server.rate_limited = airtable.AIRTABLE_RATE_LIMIT_RETRIES + 1
+
+        response = self.session.get(self.url)
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(
+            len(self.server.requests), airtable.AIRTABLE_RATE_LIMIT_RETRIES + 1
+        )
+
+    def test_prepared_requests_get_a_timeout(self) -> None:
+        prepared = self.session.prepare_request(requests.Request("GET", self.url))
+
+        with patch.object(http.Session, "send") as send:
+            send.return_value.status_code = 200
+            self.session.send(prepared, timeout=None)
+
+        self.assertEqual(send.call_args.kwargs["timeout"], http.DEFAULT_TIMEOUT)
+
+
+class testServicesTable(unittest.TestCase):
+    def setUp(self) -> None:
+        patcher = patch.multiple(airtable, _session=None, _services_table=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_table_is_shared_and_uses_the_shared_session(self) -> None:
+        table = airtable.services_table()
+
+        self.assertIs(airtable.services_table(), table)
+        self.assertIs(table.session, airtable.session())
+        self.assertEqual(
+            table.session.headers["Authorization"],
+            "Bearer {}".format(airtable.AIRTABLE_API_KEY),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,454 @@
+import os
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import MagicMock, patch
+
+from interfaces import wordpress
+
+
+def responseFactory(posts, status_code: int = 200):
+    response = MagicMock()
+    response.ok = status_code < 400
+    response.status_code = status_code
+    response.json.return_value = posts
+    return response
+
+
+def postFactory(**kwargs):
+    post = {
+        "id": 123,
+        "title": {"raw": "Sung Eucharist", "rendered": "Sung Eucharist"},
+        "slug": "sung-eucharist-2026-10-18",
+        "date": "2026-10-17T10:30:00",
+        "acf": {
+            "datetime": "2026-10-18 10:30:00",
+            "physical": True,
+            "show_bcp_reproduction_notice": False,
+            "streamed": False,
+        },
+        "excerpt": {"raw": "A said service.", "rendered": "<p>A said service.</p>\n"},
+        "featured_media": 456,
+    }
+    post.update(kwargs)
+    return post
+
+
+def resourceBodyFactory(**kwargs):
+    body = {
+        "title": "Sung Eucharist",
+        "slug": "sung-eucharist-2026-10-18",
+        "date": "2026-10-17T10:30:00+01:00",
+        "acf": {
+            "datetime": "2026-10-18 10:30:00",
+            "physical": True,
+            "show_bcp_reproduction_notice": False,
+            "streamed": False,
+        },
+        "excerpt": "A said service.",
+        "featured_media": 456,
+    }
+    body.update(kwargs)
+    return body
+
+
+class testPostMatches(unittest.TestCase):
+    def test_identical_post_matches(self) -> None:
+        self.assertTrue(wordpress.post_matches(postFactory(), resourceBodyFactory()))
+
+    def test_missing_post_does_not_match(self) -> None:
+        self.assertFalse(wordpress.post_matches(None, resourceBodyFactory()))
+
+    def test_changed_title_does_not_match(self) -> None:
+        self.assertFalse(
+            wordpress.post_matches(
+                postFactory(), resourceBodyFactory(title="Choral Evensong")
+            )
+        )
+
+    def test_changed_acf_field_does_not_match(self) -> None:
+        body = resourceBodyFactory()
+        body["acf"]["youtube"] = "dQw4w9WgXcQ"
+
+        self.assertFalse(wordpress.post_matches(postFactory(), body))
+
+    def test_acf_booleans_match_however_they_are_stored(self) -> None:
+        post = postFactory()
+        post["acf"].update({"physical": "1", "show_bcp_reproduction_notice": 0})
+
+        self.assertTrue(wordpress.post_matches(post, resourceBodyFactory()))
+
+    def test_dates_are_compared_in_site_time(self) -> None:
+        self.assertTrue(
+            wordpress.post_matches(
+                postFactory(), resourceBodyFactory(date="2026-10-17T09:30:00+00:00")
+            )
+        )
+        self.assertFalse(
+            wordpress.post_matches(
+                postFactory(), resourceBodyFactory(date="2026-10-17T10:30:00+00:00")
+            )
+        )
+
+    def test_featured_media_is_compared_as_an_id(self) -> None:
+        self.assertTrue(
+            wordpress.post_matches(
+                postFactory(), resourceBodyFactory(featured_media="456")
+            )
+        )
+
+
+class testFetchPosts(unittest.TestCase):
+    def setUp(self) -> None:
+        self.session = MagicMock()
+        patcher = patch.object(wordpress, "session", return_value=self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_fetches_posts_in_pages(self) -> None:
+        self.session.get.side_effect = [
+            responseFactory([{"id": post_id} for post_id in range(1, 101)]),
+            responseFactory([{"id": 101}]),
+        ]
+
+        posts = wordpress.fetch_posts(wordpress.url, range(1, 102))
+
+        self.assertEqual(self.session.get.call_count, 2)
+        self.assertEqual(len(posts), 101)
+        self.assertEqual(posts["101"], {"id": 101})
+
+        params = self.session.get.call_args_list[1].kwargs["params"]
+        self.assertEqual(params["include"], "101")
+        self.assertEqual(params["_fields"], wordpress.POST_FIELDS)
+
+    def test_skips_missing_ids(self) -> None:
+        posts = wordpress.fetch_posts(wordpress.url, [None, ""])
+
+        self.assertEqual(posts, {})
+        self.session.get.assert_not_called()
+
+    def test_failed_pages_are_left_out(self) -> None:
+        self.session.get.return_value = responseFactory({}, status_code=500)
+
+        self.assertEqual(wordpress.fetch_posts(wordpress.url, ["1"]), {})
+
+
+class testWriteQueue(unittest.TestCase):
+    def setUp(self) -> None:
+        self.session = MagicMock()
+        patcher = patch.object(wordpress, "session", return_value=self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.written: list[int] = []
+
+    def record(self, response) -> None:
+        self.written.append(response["id"])
+
+    def queueWrites(self, queue, count: int) -> None:
+        for post_id in range(1, count + 1):
+            queue.add(
+                wordpress.url + "/{}".format(post_id), {"id": post_id}, self.record
+            )
+
+    def test_writes_are_sent_in_batches(self) -> None:
+        self.session.post.side_effect = lambda url, json: responseFactory(
+            {
+                "responses": [
+                    {"status": 200, "body": request["body"]}
+                    for request in json["requests"]
+                ]
+            }
+        )
+
+        queue = wordpress.WriteQueue()
+        self.queueWrites(queue, 30)
+        queue.flush()
+
+        self.assertEqual(self.session.post.call_count, 2)
+        self.assertEqual(self.written, list(range(1, 31)))
+
+        first_batch = self.session.post.call_args_list[0]
+        self.assertEqual(first_batch.args[0], wordpress.batch_url)
+        self.assertEqual(len(first_batch.kwargs["json"]["requests"]), 25)
+        self.assertEqual(
+            first_batch.kwargs["json"]["requests"][0]["path"], "/wp/v2/whitkirk_oos/1"
+        )
+
+    def test_falls_back_to_single_writes_without_batching(self) -> None:
+        self.session.post.return_value = responseFactory(
+            {"code": "rest_no_route"}, status_code=404
+        )
+        self.session.request.side_effect = lambda method, url, json: responseFactory(
+            json
+        )
+
+        queue = wordpress.WriteQueue()
+        self.queueWrites(queue, 3)
+        queue.flush()
+        self.queueWrites(queue, 2)
+        queue.flush()
+
+        self.assertFalse(queue.supported)
+        # One attempt at batching, then every write on its own
+        self.assertEqual(self.session.post.call_count, 1)
+        self.assertEqual(self.session.request.call_count, 5)
+        self.assertEqual(self.written, [1, 2, 3, 1, 2])
+
+    def test_failed_batches_are_not_sent_again(self) -> None:
+        self.session.post.return_value = responseFactory({}, status_code=504)
+
+        queue = wordpress.WriteQueue()
+        self.queueWrites(queue, 3)
+        queue.flush()
+
+        self.assertTrue(queue.supported)
+        self.session.request.assert_not_called()
+        self.assertEqual(self.written, [])
+
+    def test_failed_writes_are_not_recorded(self) -> None:
+        self.session.post.return_value = responseFactory(
+            {
+                "responses": [
+                    {"status": 200, "body": {"id": 1}},
+                    {"status": 500, "body": {"message": "Oops"}},
+                ]
+            }
+        )
+
+        queue = wordpress.WriteQueue()
+        self.queueWrites(queue, 2)
+        queue.flush()
+
+        self.assertEqual(self.written, [1])
+
+    def test_writes_without_a_queue_are_sent_straight_away(self) -> None:
+        self.session.request.return_value = responseFactory({"id": 7})
+
+        wordpress.write(wordpress.url + "/7", {"id": 7}, self.record)
+
+        self.assertEqual(self.written, [7])
+
+    def test_media_deletes_are_batched_with_other_writes(self) -> None:
+        self.session.post.return_value = responseFactory(
+            {"responses": [{"status": 200, "body": {"id": 1}}, {"status": 200}]}
+        )
+
+        queue = wordpress.WriteQueue()
+        self.queueWrites(queue, 1)
+        wordpress.delete_media(456, queue=queue)
+        queue.flush()
+
+        requests = self.session.post.call_args.kwargs["json"]["requests"]
+        self.assertEqual(
+            requests[1], {"method": "DELETE", "path": "/wp/v2/media/456?force=true"}
+        )
+        self.assertEqual(self.written, [1])
+
+
+class testUploadMedia(unittest.TestCase):
+    def setUp(self) -> None:
+        self.session = MagicMock()
+        patcher = patch.object(wordpress, "upload_session", return_value=self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        image = tempfile.NamedTemporaryFile(suffix=".png", delete=False)
+        image.write(b"image data")
+        image.close()
+        self.image_path = image.name
+        self.addCleanup(os.remove, self.image_path)
+
+    def test_streams_the_file_into_the_request(self) -> None:
+        def respond(url, data, headers):
+            # Read the body as it would be sent
+            self.sent = data.read()
+            return responseFactory({"id": 789})
+
+        self.session.post.side_effect = respond
+
+        response = wordpress.upload_media(
+            self.image_path, "image.png", {"title": "Featured image"}
+        )
+
+        self.assertEqual(response, {"id": 789})
+        self.assertIn(b"image data", self.sent)
+        self.assertIn(b"Content-Type: image/png", self.sent)
+
+    def test_failed_uploads_return_nothing(self) -> None:
+        self.session.post.return_value = responseFactory({}, status_code=500)
+
+        self.assertIsNone(wordpress.upload_media(self.image_path, "image.png", {}))
+
+
+class UploadHandler(BaseHTTPRequestHandler):
+    # Turns away the first upload as unavailable, then accepts the next
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        self.server.bodies.append(self.rfile.read(length))
+
+        if len(self.server.bodies) == 1:
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = b'{"id": 789}'
+        self.send_response(201)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class UploadServer(HTTPServer):
+    bodies: list[bytes]
+
+
+class testUploadRetries(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = UploadServer(("127.0.0.1", 0), UploadHandler)
+        self.server.bodies = []
+
+        thread = threading.Thread(
+            target=self.server.serve_forever,
+            kwargs={"poll_interval": 0.01},
+            daemon=True,
+        )
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        for patcher in (
+            patch.object(
+                wordpress,
+                "media_url",
+                "http://127.0.0.1:{}/media".format(self.server.server_port),
+            ),
+            patch.object(wordpress, "_upload_session", None),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        image = tempfile.NamedTemporaryFile(suffix=".jpg", delete=False)
+        image.write(b"image data" * 10000)
+        image.close()
+        self.image_path = image.name
+        self.addCleanup(os.remove, self.image_path)
+
+    def test_unavailable_uploads_are_sent_again_in_full(self) -> None:
+        response = wordpress.upload_media(self.image_path, "image.jpg", {})
+
+        self.assertEqual(response, {"id": 789})
+        self.assertEqual(len(self.server.bodies), 2)
+        # Each attempt has its own multipart boundary, but carries the whole file
+        for body in self.server.bodies:
+            self.assertIn(b"image data" * 10000, body)
+
+
+class testMediaIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.index_path = os.path.join(self.directory.name, "media.json")
+
+    def test_shared_attachments_are_kept_until_unused(self) -> None:
+        index = wordpress.MediaIndex(self.index_path)
+        index.use("sha256:abc", 10, "recA")
+        index.use("sha256:abc", 10, "recB")
+
+        self.assertEqual(index.media_id("sha256:abc"), "10")
+        self.assertTrue(index.release(10, "recA"))
+        self.assertFalse(index.release(10, "recB"))
+        self.assertIsNone(index.media_id("sha256:abc"))
+
+    def test_index_is_kept_between_runs(self) -> None:
+        index = wordpress.MediaIndex(self.index_path)
+        index.use("sha256:abc", 10, "recA")
+        index.save()
+
+        self.assertEqual(
+            wordpress.MediaIndex(self.index_path).users(10),
+            ["recA"],
+        )
+
+
+class testUseFeaturedImage(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+        self.index = wordpress.MediaIndex(os.path.join(self.directory.name, "m.json"))
+        self.services_table = MagicMock()
+        self.upload_media = MagicMock(return_value={"id": 99})
+        self.delete_media = MagicMock()
+
+        for target, value in (
+            ("media_index", MagicMock(return_value=self.index)),
+            ("upload_media", self.upload_media),
+            ("delete_media", self.delete_media),
+        ):
+            patcher = patch.object(wordpress, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def serviceFactory(self, service_id, media_id=None, last_uploaded=None):
+        service = MagicMock()
+        service.id = service_id
+        service.wordpress_image_id = media_id
+        service.wordpress_image_last_uploaded_name = last_uploaded
+        return service
+
+    def useImage(self, service, digest="sha256:new"):
+        return wordpress.use_featured_image(
+            service, self.services_table, "image.jpg", "image.jpg", digest, {}
+        )
+
+    def test_identical_images_share_one_upload(self) -> None:
+        self.assertEqual(self.useImage(self.serviceFactory("recA")), 99)
+        self.assertEqual(self.useImage(self.serviceFactory("recB")), 99)
+
+        self.upload_media.assert_called_once()
+        self.assertEqual(self.index.users(99), ["recA", "recB"])
+        self.services_table.update.assert_called_with(
+            "recB",
+            {
+                wordpress.AIRTABLE_MAP["wp_image_id"]: "99",
+                wordpress.AIRTABLE_MAP["wp_image_last_uploaded_name"]: "sha256:new",
+            },
+        )
+
+    def test_replaced_image_is_deleted_once_unused(self) -> None:
+        self.useImage(self.serviceFactory("recA", "10", "sha256:old"))
+
+        self.delete_media.assert_called_once_with("10", queue=None)
+
+    def test_replaced_image_still_in_use_is_kept(self) -> None:
+        self.index.use("sha256:old", 10, "recA")
+        self.index.use("sha256:old", 10, "recB")
+
+        self.useImage(self.serviceFactory("recA", "10", "sha256:old"))
+
+        self.delete_media.assert_not_called()
+
+    def test_default_images_are_never_deleted(self) -> None:
+        self.useImage(self.serviceFactory("recA", "1"))
+
+        self.delete_media.assert_not_called()
+
+    def test_failed_upload_leaves_everything_alone(self) -> None:
+        self.upload_media.return_value = None
+
+        self.assertIsNone(self.useImage(self.serviceFactory("recA", "10", "old.jpg")))
+
+        self.services_table.update.assert_not_called()
+        self.delete_media.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
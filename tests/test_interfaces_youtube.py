@@ -1,7 +1,27 @@
+import datetime
+import os
+import tempfile
+import time
 import unittest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
-from interfaces.youtube import Playlist, PlaylistManager
+import google.oauth2.credentials
+import googleapiclient.errors
+import httplib2
+from factories import serviceFactory
+
+from interfaces.youtube import (
+    YOUTUBE_QUOTA_COSTS,
+    BroadcastSync,
+    CredentialsProvider,
+    Playlist,
+    PlaylistManager,
+    QuotaLedger,
+    broadcast_resource_body,
+    broadcast_state_digest,
+    video_resource_body,
+)
+from services import AIRTABLE_MAP
 
 
 class testYoutubePlaylist(unittest.TestCase):
@@ -31,7 +51,7 @@ class testYoutubePlaylist(unittest.TestCase):
 
         api.client.playlistItems().list().execute.assert_called_once()
 
-        self.assertEqual(playlist.videos_in_list, ["OnE", "tWo", "ThReE"])
+        self.assertEqual(playlist.videos_in_list, {"OnE", "tWo", "ThReE"})
 
     @patch("interfaces.youtube.Api")
     def test_load_items_over_multiple_pages(self, api) -> None:
@@ -77,7 +97,7 @@ class testYoutubePlaylist(unittest.TestCase):
         self.assertEqual(api.client.playlistItems().list().execute.call_count, 2)
 
         self.assertEqual(
-            playlist.videos_in_list, ["OnE", "tWo", "ThReE", "fOuR", "fIvE"]
+            playlist.videos_in_list, {"OnE", "tWo", "ThReE", "fOuR", "fIvE"}
         )
 
     @patch("interfaces.youtube.Api")
@@ -88,6 +108,36 @@ class testYoutubePlaylist(unittest.TestCase):
 
         self.assertEqual(playlist.items, ["OnE", "tWo", "ThReE"])
 
+    @patch("interfaces.youtube.Api")
+    def test_contains_checks_unknown_videos_with_youtube(self, api) -> None:
+        api.client.playlistItems().list().execute.return_value = {
+            "items": [{"id": "PlAyLiStItEm"}]
+        }
+        playlist = Playlist(api, "PlAyLiSt", video_ids=["OnE"])
+
+        self.assertTrue(playlist.contains("OnE"))
+        api.client.playlistItems().list().execute.assert_not_called()
+
+        self.assertTrue(playlist.contains("tWo"))
+        api.client.playlistItems().list.assert_called_with(
+            part="id", maxResults=1, playlistId="PlAyLiSt", videoId="tWo"
+        )
+        self.assertIn("tWo", playlist.items)
+
+    @patch("interfaces.youtube.Api")
+    def test_contains_remembers_missing_videos(self, api) -> None:
+        api.client.playlistItems().list().execute.return_value = {"items": []}
+        playlist = Playlist(api, "PlAyLiSt", video_ids=[])
+
+        self.assertFalse(playlist.contains("OnE"))
+        self.assertFalse(playlist.contains("OnE"))
+
+        api.client.playlistItems().list().execute.assert_called_once()
+
+        playlist.add("OnE")
+
+        self.assertTrue(playlist.contains("OnE"))
+
 
 class testYoutubePlaylistManager(unittest.TestCase):
     @patch("interfaces.youtube.Api")
@@ -105,6 +155,583 @@ class testYoutubePlaylistManager(unittest.TestCase):
 
         self.assertEqual(id(playlist_1), id(playlist_2))
 
+    @patch("interfaces.youtube.Api")
+    def test_index_is_saved_and_reused(self, api) -> None:
+        api.client.playlistItems().list().execute.return_value = {
+            "items": [
+                {"snippet": {"resourceId": {"kind": "youtube#video", "videoId": "OnE"}}}
+            ]
+        }
+
+        with tempfile.TemporaryDirectory() as directory:
+            index_path = os.path.join(directory, "playlists.json")
+
+            manager = PlaylistManager(api, index_path=index_path)
+            manager.get("PlAyLiSt").add("tWo")
+            manager.save()
+
+            api.client.playlistItems().list().execute.reset_mock()
+
+            playlist = PlaylistManager(api, index_path=index_path).get("PlAyLiSt")
+
+        api.client.playlistItems().list().execute.assert_not_called()
+        self.assertEqual(playlist.items, {"OnE", "tWo"})
+
+
+def write_token(path, expiry) -> None:
+    creds = google.oauth2.credentials.Credentials(
+        "ToKeN",
+        refresh_token="ReFrEsH",
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id="ClIeNt",
+        client_secret="SeCrEt",
+        expiry=expiry,
+    )
+
+    with open(path, "w") as token:
+        token.write(creds.to_json())
+
+
+class testYoutubeCredentialsProvider(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.token_path = os.path.join(self.directory.name, "token.json")
+        self.bucket = MagicMock()
+        self.provider = CredentialsProvider(self.token_path, bucket=self.bucket)
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def future(self):
+        return datetime.datetime.now(datetime.timezone.utc).replace(
+            tzinfo=None
+        ) + datetime.timedelta(hours=1)
+
+    def past(self):
+        return datetime.datetime.now(datetime.timezone.utc).replace(
+            tzinfo=None
+        ) - datetime.timedelta(hours=1)
+
+    def test_valid_local_token_skips_s3(self) -> None:
+        write_token(self.token_path, self.future())
+
+        self.assertTrue(self.provider.credentials().valid)
+
+        self.bucket.download_file.assert_not_called()
+        self.bucket.upload_file.assert_not_called()
+
+    def test_missing_local_token_is_downloaded_but_not_uploaded(self) -> None:
+        self.bucket.download_file.side_effect = lambda key, path: write_token(
+            path, self.future()
+        )
+
+        self.assertTrue(self.provider.credentials().valid)
+
+        self.bucket.download_file.assert_called_once()
+        self.bucket.upload_file.assert_not_called()
+
+    @patch("google.oauth2.credentials.Credentials.refresh")
+    def test_expired_token_is_refreshed_and_uploaded(self, refresh) -> None:
+        write_token(self.token_path, self.past())
+        self.bucket.download_file.side_effect = lambda key, path: write_token(
+            path, self.past()
+        )
+
+        self.provider.credentials()
+
+        refresh.assert_called_once()
+        self.bucket.upload_file.assert_called_once_with(self.token_path, "token.json")
+
+
+class FakeBatch:
+    def __init__(self, responder, batches):
+        self.responder = responder
+        self.requests = []
+
+        batches.append(self)
+
+    def add(self, request, callback, request_id):
+        self.requests.append((request_id, callback))
+
+    def execute(self):
+        for request_id, callback in self.requests:
+            callback(request_id, *self.responder(request_id))
+
+
+class BrokenBatch(FakeBatch):
+    # A batch whose connection drops before any of it is answered
+    def execute(self):
+        raise httplib2.HttpLib2Error("Connection reset")
+
+
+def http_error():
+    return googleapiclient.errors.HttpError(MagicMock(status=500), b"")
+
+
+class testYoutubeBroadcastSync(unittest.TestCase):
+    def setUp(self) -> None:
+        self.batches: list[FakeBatch] = []
+        self.failing: set[str] = set()
+        self.broken_batches: set[int] = set()
+        self.client = MagicMock()
+        self.client.new_batch_http_request.side_effect = self.new_batch
+
+    def new_batch(self):
+        if len(self.batches) in self.broken_batches:
+            return BrokenBatch(self.respond, self.batches)
+
+        return FakeBatch(self.respond, self.batches)
+
+    def respond(self, request_id):
+        if request_id in self.failing:
+            return None, http_error()
+
+        service_id, _, playlist_id = request_id.partition(":")
+
+        return {
+            "id": "ViDeO" + service_id,
+            "snippet": {"playlistId": playlist_id},
+        }, None
+
+    def services(self, count):
+        return [
+            serviceFactory(
+                {
+                    AIRTABLE_MAP["name"]: "Service {}".format(index),
+                    AIRTABLE_MAP["datetime"]: "2022-01-01T10:00:00.000Z",
+                },
+                id="rec{}".format(index),
+            )
+            for index in range(count)
+        ]
+
+    def test_upsert_sends_one_batch_per_fifty_services(self) -> None:
+        upserted = []
+        sync = BroadcastSync(self.client, "StReAm", self.services(60))
+
+        sync.upsert_broadcasts(on_upserted=lambda job: upserted.append(job.video_id))
+
+        self.assertEqual([len(batch.requests) for batch in self.batches], [50, 10])
+        self.assertEqual(len(upserted), 60)
+        self.assertEqual(sync.jobs["rec0"].video_id, "ViDeOrec0")
+
+    def test_failed_services_are_left_out_of_later_stages(self) -> None:
+        sync = BroadcastSync(self.client, "StReAm", self.services(3))
+
+        sync.upsert_broadcasts()
+        self.failing.add("rec1")
+        sync.bind_streams()
+        sync.update_videos()
+
+        self.assertEqual(
+            [request_id for request_id, _ in self.batches[-1].requests],
+            ["rec0", "rec2"],
+        )
+        self.assertEqual(list(sync.errors), ["rec1"])
+
+    def pushed_service(self, **fields):
+        service = serviceFactory(
+            {
+                AIRTABLE_MAP["name"]: "Pushed Service",
+                AIRTABLE_MAP["datetime"]: "2022-01-01T10:00:00.000Z",
+                AIRTABLE_MAP["youtube_id"]: "ViDeO",
+            },
+            id="recPuShEd",
+        )
+        service.update_fields(
+            {
+                AIRTABLE_MAP["youtube_state_digest"]: broadcast_state_digest(
+                    service, "StReAm"
+                ),
+                **fields,
+            }
+        )
+
+        return service
+
+    def test_failed_batch_only_fails_its_own_services(self) -> None:
+        upserted = []
+        self.broken_batches = {0}
+        sync = BroadcastSync(self.client, "StReAm", self.services(60))
+
+        sync.upsert_broadcasts(on_upserted=lambda job: upserted.append(job.service.id))
+
+        self.assertEqual(len(self.batches), 2)
+        self.assertEqual(
+            sorted(sync.errors), sorted("rec{}".format(index) for index in range(50))
+        )
+        self.assertEqual(upserted, ["rec{}".format(index) for index in range(50, 60)])
+
+    def test_unchanged_broadcasts_are_skipped(self) -> None:
+        sync = BroadcastSync(
+            self.client, "StReAm", self.services(1) + [self.pushed_service()]
+        )
+
+        sync.upsert_broadcasts()
+        sync.bind_streams()
+
+        self.assertEqual(
+            [request_id for request_id, _ in self.batches[-1].requests], ["rec0"]
+        )
+
+    def test_changed_broadcasts_are_pushed(self) -> None:
+        service = self.pushed_service(**{AIRTABLE_MAP["name"]: "Renamed Service"})
+        sync = BroadcastSync(self.client, "StReAm", [service])
+
+        self.assertTrue(sync.jobs["recPuShEd"].changed)
+
+    def test_force_pushes_unchanged_broadcasts(self) -> None:
+        updated = []
+        sync = BroadcastSync(self.client, "StReAm", [self.pushed_service()], force=True)
+
+        sync.upsert_broadcasts()
+        sync.update_videos(on_updated=lambda job: updated.append(job.service.id))
+
+        self.assertEqual(updated, ["recPuShEd"])
+
+    def test_add_to_playlists_skips_existing_items(self) -> None:
+        playlists = MagicMock()
+        playlists.get().contains.side_effect = (
+            lambda video_id, http=None: video_id == "ViDeOrec0"
+        )
+        sync = BroadcastSync(
+            self.client, "StReAm", self.services(2), playlists=playlists
+        )
+
+        sync.upsert_broadcasts()
+        sync.add_to_playlists()
+
+        self.assertEqual(
+            [request_id.split(":")[0] for request_id, _ in self.batches[-1].requests],
+            ["rec1"],
+        )
+        playlists.get().add.assert_called_once_with("ViDeOrec1")
+        playlists.save.assert_called_once()
+
+    def test_failed_playlist_lookup_only_fails_its_service(self) -> None:
+        def contains(video_id, http=None):
+            if video_id == "ViDeOrec0":
+                raise http_error()
+
+            return False
+
+        playlists = MagicMock()
+        playlists.get().contains.side_effect = contains
+        sync = BroadcastSync(
+            self.client, "StReAm", self.services(3), playlists=playlists
+        )
+
+        sync.upsert_broadcasts()
+        sync.add_to_playlists()
+
+        self.assertEqual(
+            [request_id.split(":")[0] for request_id, _ in self.batches[-1].requests],
+            ["rec1", "rec2"],
+        )
+        self.assertEqual(list(sync.errors), ["rec0"])
+        playlists.save.assert_called_once()
+
+
+class FakeRequest:
+    def __init__(self, operation, video_id, log, failing):
+        self.operation = operation
+        self.video_id = video_id
+        self.log = log
+        self.failing = failing
+
+    def execute(self, http=None):
+        if (self.operation, self.video_id) in self.failing:
+            raise http_error()
+
+        self.log.append((self.operation, self.video_id, http))
+        return {"id": self.video_id}
+
+
+class FakeResource:
+    def __init__(self, name, log, failing):
+        self.name = name
+        self.log = log
+        self.failing = failing
+
+    def __getattr__(self, method):
+        def build_request(**kwargs):
+            body = kwargs.get("body", {})
+
+            if method == "insert" and self.name == "liveBroadcasts":
+                video_id = "ViDeO-" + body["snippet"]["title"]
+            elif method == "insert":
+                video_id = body["snippet"]["resourceId"]["videoId"]
+            else:
+                video_id = kwargs.get("id") or kwargs.get("videoId") or body["id"]
+
+            return FakeRequest(
+                "{}.{}".format(self.name, method), video_id, self.log, self.failing
+            )
+
+        return build_request
+
+
+class FakeClient:
+    def __init__(self, failing=()):
+        self.log = []
+        self.failing = set(failing)
+
+    def __getattr__(self, name):
+        return lambda: FakeResource(name, self.log, self.failing)
+
+
+class testYoutubeConcurrentSync(unittest.TestCase):
+    def services(self):
+        return [
+            serviceFactory(
+                {
+                    AIRTABLE_MAP["name"]: "Service {}".format(index),
+                    AIRTABLE_MAP["datetime"]: "2022-01-01T10:00:00.000Z",
+                },
+                id="rec{}".format(index),
+            )
+            for index in range(6)
+        ]
+
+    def test_each_service_runs_its_stages_in_order(self) -> None:
+        client = FakeClient()
+        playlists = MagicMock()
+        playlists.get().contains.return_value = False
+        upserted = []
+
+        sync = BroadcastSync(
+            client,
+            "StReAm",
+            self.services(),
+            playlists=playlists,
+            http_factory=object,
+        )
+        sync.run_concurrently(
+            3,
+            {"rec0": "images/default_thumbnails/service.jpg"},
+            on_upserted=lambda job: upserted.append(job.service.id),
+        )
+
+        self.assertEqual(
+            sorted(upserted), ["rec{}".format(index) for index in range(6)]
+        )
+
+        operations = [
+            operation
+            for operation, video_id, _ in client.log
+            if video_id == "ViDeO-Service 0: 1 January 2022"
+        ]
+        self.assertEqual(
+            operations,
+            [
+                "liveBroadcasts.insert",
+                "liveBroadcasts.bind",
+                "videos.update",
+                "thumbnails.set",
+                "playlistItems.insert",
+            ],
+        )
+
+        # Every call went through a connection belonging to its thread
+        self.assertLessEqual(len({id(http) for _, _, http in client.log}), 3)
+        self.assertNotIn(None, [http for _, _, http in client.log])
+
+    def test_errors_are_collected_per_service(self) -> None:
+        client = FakeClient(
+            failing={("liveBroadcasts.bind", "ViDeO-Service 1: 1 January 2022")}
+        )
+        playlists = MagicMock()
+        playlists.get().contains.return_value = True
+
+        sync = BroadcastSync(client, "StReAm", self.services(), playlists=playlists)
+        sync.run_concurrently(3, {})
+
+        self.assertEqual(list(sync.errors), ["rec1"])
+        self.assertNotIn(
+            ("videos.update", "ViDeO-Service 1: 1 January 2022", None), client.log
+        )
+        self.assertEqual(
+            len([entry for entry in client.log if entry[0] == "videos.update"]), 5
+        )
+
+
+class testYoutubeQuota(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = MagicMock()
+        self.client.new_batch_http_request.side_effect = lambda: FakeBatch(
+            lambda request_id: ({"id": "ViDeO" + request_id}, None), []
+        )
+
+    def services(self):
+        # Listed out of order, to check that the nearest come first
+        return [
+            serviceFactory(
+                {
+                    AIRTABLE_MAP["name"]: "Service {}".format(day),
+                    AIRTABLE_MAP["datetime"]: "2022-01-0{}T10:00:00.000Z".format(day),
+                },
+                id="rec{}".format(day),
+            )
+            for day in (3, 1, 2)
+        ]
+
+    def test_ledger_totals_by_operation(self) -> None:
+        quota = QuotaLedger(100)
+
+        quota.record("videos.list")
+        quota.record("videos.list")
+        self.assertTrue(quota.spend("videos.update"))
+        self.assertFalse(quota.spend("thumbnails.set"))
+
+        self.assertEqual(dict(quota.units), {"videos.list": 2, "videos.update": 50})
+        self.assertEqual(quota.remaining, 48)
+
+    def test_plan_defers_the_furthest_off_services(self) -> None:
+        # Each new service needs an insert, bind, video update and playlist insert,
+        # plus a playlist lookup
+        sync = BroadcastSync(
+            self.client, "StReAm", self.services(), quota=QuotaLedger(500)
+        )
+
+        self.assertEqual(sync.plan(), 402)
+        self.assertEqual(
+            [job.service.id for job in sync.pending_jobs], ["rec1", "rec2"]
+        )
+        self.assertEqual([job.service.id for job in sync.deferred_jobs], ["rec3"])
+
+    def test_estimate_counts_drifted_playlist_membership(self) -> None:
+        service = serviceFactory(
+            {
+                AIRTABLE_MAP["name"]: "Pushed Service",
+                AIRTABLE_MAP["datetime"]: "2022-01-01T10:00:00.000Z",
+                AIRTABLE_MAP["youtube_id"]: "ViDeO",
+            },
+            id="recPuShEd",
+        )
+        playlist_ids = list(service.youtube_playlists_for_service)
+
+        with tempfile.TemporaryDirectory() as directory:
+            playlists = PlaylistManager(
+                MagicMock(), index_path=os.path.join(directory, "playlists.json")
+            )
+            sync = BroadcastSync(self.client, "StReAm", [service], playlists=playlists)
+            job = sync.jobs["recPuShEd"]
+
+            drifted_cost = sync.estimated_cost(job)
+
+            playlists.index = {
+                playlist_id: {"loaded_at": time.time(), "videos": ["ViDeO"]}
+                for playlist_id in playlist_ids
+            }
+
+            known_cost = sync.estimated_cost(job)
+
+        self.assertEqual(
+            drifted_cost - known_cost,
+            len(playlist_ids)
+            * (
+                YOUTUBE_QUOTA_COSTS["playlistItems.list"]
+                + YOUTUBE_QUOTA_COSTS["playlistItems.insert"]
+            ),
+        )
+
+    def test_stages_defer_rather_than_overspend(self) -> None:
+        quota = QuotaLedger(120)
+        sync = BroadcastSync(self.client, "StReAm", self.services(), quota=quota)
+
+        sync.upsert_broadcasts()
+
+        self.assertEqual(quota.calls["liveBroadcasts.insert"], 2)
+        self.assertEqual([job.service.id for job in sync.deferred_jobs], ["rec3"])
+
+
+class testYoutubeBroadcastReconcile(unittest.TestCase):
+    def setUp(self) -> None:
+        self.service = serviceFactory(
+            {
+                AIRTABLE_MAP["name"]: "Pushed Service",
+                AIRTABLE_MAP["datetime"]: "2022-01-01T10:00:00.000Z",
+                AIRTABLE_MAP["youtube_id"]: "ViDeO",
+            },
+            id="recPuShEd",
+        )
+        self.client = MagicMock()
+
+        broadcast = broadcast_resource_body(self.service, "ViDeO")
+        broadcast["snippet"]["scheduledStartTime"] = "2022-01-01T10:00:00Z"
+        broadcast["contentDetails"] = {"boundStreamId": "StReAm"}
+        self.broadcast = broadcast
+
+        video = video_resource_body(self.service, "ViDeO")
+        video["snippet"]["liveBroadcastContent"] = "upcoming"
+        self.video = video
+
+    def reconciled_job(self):
+        self.client.liveBroadcasts().list().execute.return_value = {
+            "items": [self.broadcast]
+        }
+        self.client.videos().list().execute.return_value = {"items": [self.video]}
+
+        sync = BroadcastSync(self.client, "StReAm", [self.service])
+        sync.reconcile()
+
+        return sync.jobs["recPuShEd"]
+
+    def test_matching_broadcasts_need_nothing(self) -> None:
+        self.assertEqual(self.reconciled_job().stages, set())
+
+    def test_remote_changes_are_put_back(self) -> None:
+        self.service.update_fields(
+            {
+                AIRTABLE_MAP["youtube_state_digest"]: broadcast_state_digest(
+                    self.service, "StReAm"
+                )
+            }
+        )
+        self.broadcast["snippet"]["title"] = "Edited on YouTube"
+
+        self.assertEqual(self.reconciled_job().stages, {"upsert"})
+
+    def test_broadcasts_bound_elsewhere_are_rebound(self) -> None:
+        self.broadcast["contentDetails"]["boundStreamId"] = "OtHeR"
+
+        self.assertEqual(self.reconciled_job().stages, {"bind"})
+
+    def test_live_broadcasts_are_left_alone(self) -> None:
+        self.video["snippet"]["liveBroadcastContent"] = "live"
+        self.broadcast["snippet"]["title"] = "Edited on YouTube"
+
+        job = self.reconciled_job()
+
+        self.assertTrue(job.finished)
+        self.assertEqual(job.stages, set())
+
+    def test_failed_video_fetch_goes_on_last_push(self) -> None:
+        self.client.videos().list().execute.side_effect = http_error()
+
+        job = self.reconciled_job()
+
+        self.assertEqual(job.video_id, "ViDeO")
+        self.assertEqual(job.stages, {"upsert", "bind", "video"})
+
+    def test_failed_broadcast_fetch_goes_on_last_push(self) -> None:
+        self.client.liveBroadcasts().list().execute.side_effect = (
+            httplib2.HttpLib2Error("Connection reset")
+        )
+
+        job = self.reconciled_job()
+
+        self.assertEqual(job.video_id, "ViDeO")
+        self.assertEqual(job.stages, {"upsert", "bind", "video"})
+
+    def test_missing_videos_are_recreated(self) -> None:
+        self.video["id"] = "SoMeThInGeLsE"
+
+        job = self.reconciled_job()
+
+        self.assertIsNone(job.video_id)
+        self.assertEqual(job.stages, {"upsert", "bind", "video"})
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,10 +1,15 @@
 import unittest
 from datetime import datetime
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 from factories import serviceFactory
 
-from services import AIRTABLE_MAP, DEFAULT_SERVICE_IMAGE, download_service_image
+from services import (
+    AIRTABLE_MAP,
+    DEFAULT_SERVICE_IMAGE,
+    ServiceRepository,
+    download_service_image,
+)
 
 
 class testService(unittest.TestCase):
@@ -374,8 +379,8 @@ class testService(unittest.TestCase):
         )
 
         download_image.side_effect = [
-            ("images/service_specific/1m4g31.jpg", []),
-            ("images/service_specific/1m4g32.jpg", []),
+            "images/service_specific/1m4g31.jpg",
+            "images/service_specific/1m4g32.jpg",
         ]
 
         self.assertEqual(
@@ -524,10 +529,70 @@ class testService(unittest.TestCase):
 
 
 class testServiceFunctions(unittest.TestCase):
-    @patch("services.urllib.request.urlretrieve")
-    def test_download_service_image(self, urlretrieve) -> None:
-        download_service_image("https://example.com/test.jpg", "test.jpg")
+    @patch("services.image_cache")
+    def test_download_service_image(self, image_cache) -> None:
+        image_cache().get.return_value = "images/service_specific/4b5c.jpg"
+
+        self.assertEqual(
+            download_service_image(
+                "https://example.com/test.jpg", "test.jpg", "attTeSt"
+            ),
+            "images/service_specific/4b5c.jpg",
+        )
+
+        image_cache().get.assert_called_with(
+            "https://example.com/test.jpg", "test.jpg", "attTeSt"
+        )
+
+
+class testServiceRepository(unittest.TestCase):
+    def setUp(self) -> None:
+        self.services_table = MagicMock()
+        self.services_table.all.return_value = [
+            {"id": "recStReAm", "fields": {AIRTABLE_MAP["streaming"]: "Yes"}},
+            {
+                "id": "recOoS",
+                "fields": {
+                    AIRTABLE_MAP["streaming"]: "No",
+                    AIRTABLE_MAP["has_oos"]: True,
+                },
+            },
+            {"id": "recUnDeCiDeD", "fields": {}},
+        ]
+        self.repository = ServiceRepository(self.services_table)
+
+    def test_views_share_a_single_scan(self) -> None:
+        self.assertEqual(
+            [service.id for service in self.repository.streaming_services()],
+            ["recStReAm"],
+        )
+        self.assertEqual(
+            [service.id for service in self.repository.services_with_oos()],
+            ["recOoS"],
+        )
+        self.assertEqual(
+            [
+                service.id
+                for service in self.repository.services_with_undecided_stream_status()
+            ],
+            ["recUnDeCiDeD"],
+        )
+
+        self.services_table.all.assert_called_once()
+
+    def test_invalidate_forces_a_new_scan(self) -> None:
+        self.repository.streaming_services()
+        self.repository.invalidate()
+        self.repository.streaming_services()
+
+        self.assertEqual(self.services_table.all.call_count, 2)
+
+    def test_update_writes_through_to_cached_service(self) -> None:
+        self.repository.streaming_services()
+        self.repository.update("recStReAm", {AIRTABLE_MAP["youtube_id"]: "a1-b2_c3"})
 
-        urlretrieve.assert_called_with(
-            "https://example.com/test.jpg", "images/service_specific/test.jpg"
+        self.services_table.update.assert_called_once_with(
+            "recStReAm", {AIRTABLE_MAP["youtube_id"]: "a1-b2_c3"}
         )
+        self.assertEqual(self.repository.streaming_services()[0].youtube_id, "a1-b2_c3")
+        self.services_table.all.assert_called_once()
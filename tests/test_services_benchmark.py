@@ -0,0 +1,142 @@
+import datetime
+import logging
+import os
+import time
+import tracemalloc
+import unittest
+
+from pyairtable import utils
+
+from services import AIRTABLE_MAP, TZ_GMT, TZ_LONDON, Service
+
+SERVICE_COUNT = 10_000
+
+# Timings are only worth having on a quiet machine, so they're opt-in
+RUN_BENCHMARKS = bool(os.environ.get("RUN_BENCHMARKS"))
+
+logger = logging.getLogger(__name__)
+
+
+def recordsFactory() -> list:
+    start = datetime.datetime(2022, 1, 2, 10, 0)
+
+    return [
+        {
+            "id": "rec{:05d}".format(index),
+            "fields": {
+                AIRTABLE_MAP["name"]: "Test Service {}".format(index),
+                AIRTABLE_MAP["datetime"]: (
+                    start + datetime.timedelta(hours=index)
+                ).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                AIRTABLE_MAP["churchsuite_category_id"]: "34",
+            },
+        }
+        for index in range(SERVICE_COUNT)
+    ]
+
+
+class LegacyService:
+    # How services used to behave: a __dict__ per instance, and every derived value
+    # re-parsed from the Airtable string on each access.
+    def __init__(self, airtable_object) -> None:
+        self.id = airtable_object["id"]
+        self.airtable_map = AIRTABLE_MAP
+        self.airtable_object = airtable_object
+        self.airtable_fields = airtable_object["fields"]
+        self.category_overrides: dict = {}
+
+    @property
+    def datetime_localised(self) -> datetime.datetime:
+        return TZ_GMT.localize(
+            utils.datetime_from_iso_str(self.airtable_fields[AIRTABLE_MAP["datetime"]])
+        ).astimezone(TZ_LONDON)
+
+    @property
+    def title_string_with_date(self) -> str:
+        return self.airtable_fields[AIRTABLE_MAP["name"]] + ": {date}".format(
+            date=self.datetime_localised.strftime("%-d %B %Y"),
+        )
+
+    @property
+    def datetime_as_naive_string(self) -> str:
+        return self.datetime_localised.strftime("%Y-%m-%d %H:%M:%S")
+
+    @property
+    def datetime_to_publish_order_of_service(self) -> datetime.datetime:
+        return self.datetime_localised - datetime.timedelta(days=1)
+
+
+def touch_derived_values(services: list) -> None:
+    # Roughly what a sync run reads from each service
+    for service in services:
+        service.datetime_localised
+        service.title_string_with_date
+        service.title_string_with_date
+        service.datetime_as_naive_string
+        service.datetime_to_publish_order_of_service
+
+
+def time_per_service(build) -> float:
+    records = recordsFactory()
+
+    started = time.perf_counter()
+    touch_derived_values(build(records))
+
+    return (time.perf_counter() - started) / SERVICE_COUNT
+
+
+def memory_per_service(build) -> int:
+    records = recordsFactory()
+
+    tracemalloc.start()
+    services = build(records)
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    del services
+
+    return allocated // SERVICE_COUNT
+
+
+class testServiceBenchmark(unittest.TestCase):
+    @unittest.skipUnless(RUN_BENCHMARKS, "set RUN_BENCHMARKS to run benchmarks")
+    def test_precomputed_services_per_service_cost(self) -> None:
+        def build_legacy(records):
+            return [LegacyService(record) for record in records]
+
+        logger.warning(
+            "%d services: %.1fµs and %dB per service before, %.1fµs and %dB after",
+            SERVICE_COUNT,
+            time_per_service(build_legacy) * 1e6,
+            memory_per_service(build_legacy),
+            time_per_service(Service.from_records) * 1e6,
+            memory_per_service(Service.from_records),
+        )
+
+    def test_precomputed_values_match_legacy_services(self) -> None:
+        records = recordsFactory()[:50]
+
+        for legacy, current in zip(
+            [LegacyService(record) for record in records],
+            Service.from_records(records),
+        ):
+            self.assertEqual(current.datetime_localised, legacy.datetime_localised)
+            self.assertEqual(
+                current.title_string_with_date, legacy.title_string_with_date
+            )
+            self.assertEqual(
+                current.datetime_as_naive_string, legacy.datetime_as_naive_string
+            )
+            self.assertEqual(
+                current.datetime_to_publish_order_of_service,
+                legacy.datetime_to_publish_order_of_service,
+            )
+
+    def test_services_have_no_instance_dict(self) -> None:
+        service = Service.from_records(recordsFactory()[:1])[0]
+
+        self.assertFalse(hasattr(service, "__dict__"))
+
+
+if __name__ == "__main__":
+    unittest.main()
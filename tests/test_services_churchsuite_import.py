@@ -0,0 +1,194 @@
+import unittest
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, patch
+
+from services import AIRTABLE_MAP
+from services.churchsuite_import import (
+    changed_fields,
+    churchsuite_id_formula,
+    event_data_blob,
+    existing_records_by_churchsuite_id,
+    plan_import,
+)
+
+
+def eventFactory(event_id: str = "123", **overrides) -> dict:
+    event = {
+        "id": event_id,
+        "identifier": "aBcDeF",
+        "name": "Test Service",
+        "datetime": datetime(2022, 1, 1, 10, 0, tzinfo=timezone.utc),
+        "category": "Regular service",
+        "category_id": 3,
+        "cancelled": False,
+    }
+    event.update(overrides)
+    return event
+
+
+class testChurchsuiteImport(unittest.TestCase):
+    def test_event_data_blob(self) -> None:
+        self.assertEqual(
+            event_data_blob(eventFactory()),
+            {
+                AIRTABLE_MAP["name"]: "Test Service",
+                AIRTABLE_MAP["datetime"]: "2022-01-01T10:00:00+00:00",
+                AIRTABLE_MAP["type"]: "Regular service",
+                AIRTABLE_MAP["churchsuite_id"]: "123",
+                AIRTABLE_MAP["churchsuite_public_identifier"]: "aBcDeF",
+                AIRTABLE_MAP["churchsuite_category_id"]: "3",
+                AIRTABLE_MAP["cancelled"]: False,
+            },
+        )
+
+    def test_event_data_blob_with_image(self) -> None:
+        blob = event_data_blob(
+            eventFactory(image_url="https://example.com/lg/1m4g3.jpg")
+        )
+
+        self.assertEqual(
+            blob[AIRTABLE_MAP["churchsuite_image"]],
+            [{"url": "https://example.com/lg/1m4g3.jpg"}],
+        )
+
+    def test_churchsuite_id_formula(self) -> None:
+        self.assertEqual(
+            churchsuite_id_formula(["1", "2"]),
+            "OR({ChurchSuite ID}='1',{ChurchSuite ID}='2')",
+        )
+
+    @patch("services.churchsuite_import.CHURCHSUITE_IDS_PER_LOOKUP", 2)
+    def test_existing_records_by_churchsuite_id(self) -> None:
+        services_table = MagicMock()
+        services_table.all.side_effect = [
+            [
+                {"id": "recOnE", "fields": {AIRTABLE_MAP["churchsuite_id"]: "1"}},
+                {"id": "recTwO", "fields": {AIRTABLE_MAP["churchsuite_id"]: "2"}},
+                {"id": "recDuPe", "fields": {AIRTABLE_MAP["churchsuite_id"]: "2"}},
+            ],
+            [],
+        ]
+
+        records = existing_records_by_churchsuite_id(services_table, ["1", "2", "3"])
+
+        self.assertEqual(services_table.all.call_count, 2)
+        self.assertEqual(records["1"]["id"], "recOnE")
+        self.assertEqual(records["2"]["id"], "recTwO")
+        self.assertNotIn("3", records)
+
+    def test_existing_records_by_churchsuite_id_without_events(self) -> None:
+        services_table = MagicMock()
+
+        self.assertEqual(existing_records_by_churchsuite_id(services_table, []), {})
+        services_table.all.assert_not_called()
+
+    def test_plan_import(self) -> None:
+        plan = plan_import(
+            {"1": eventFactory("1"), "2": eventFactory("2")},
+            {"1": {"id": "recOnE", "fields": {}}},
+        )
+
+        self.assertEqual(len(plan["update"]), 1)
+        self.assertEqual(plan["update"][0]["id"], "recOnE")
+        self.assertEqual(
+            plan["update"][0]["fields"][AIRTABLE_MAP["churchsuite_id"]], "1"
+        )
+
+        self.assertEqual(len(plan["create"]), 1)
+        self.assertEqual(plan["create"][0][AIRTABLE_MAP["churchsuite_id"]], "2")
+
+    def test_plan_import_skips_unchanged_records(self) -> None:
+        existing_fields = {
+            AIRTABLE_MAP["name"]: "Test Service",
+            AIRTABLE_MAP["datetime"]: "2022-01-01T10:00:00.000Z",
+            AIRTABLE_MAP["type"]: "Regular service",
+            AIRTABLE_MAP["churchsuite_id"]: "1",
+            AIRTABLE_MAP["churchsuite_public_identifier"]: "aBcDeF",
+            AIRTABLE_MAP["churchsuite_category_id"]: "3",
+        }
+
+        plan = plan_import(
+            {"1": eventFactory("1")},
+            {"1": {"id": "recOnE", "fields": existing_fields}},
+        )
+
+        self.assertEqual(plan["update"], [])
+        self.assertEqual(plan["create"], [])
+        self.assertEqual(plan["unchanged"], ["recOnE"])
+
+
+class testChurchsuiteImportChangedFields(unittest.TestCase):
+    def test_only_changed_fields_are_returned(self) -> None:
+        self.assertEqual(
+            changed_fields(
+                {AIRTABLE_MAP["name"]: "New Name", AIRTABLE_MAP["type"]: "Wedding"},
+                {AIRTABLE_MAP["name"]: "Old Name", AIRTABLE_MAP["type"]: "Wedding"},
+            ),
+            {AIRTABLE_MAP["name"]: "New Name"},
+        )
+
+    def test_datetimes_compare_as_instants(self) -> None:
+        self.assertEqual(
+            changed_fields(
+                {AIRTABLE_MAP["datetime"]: "2022-08-01T10:00:00+01:00"},
+                {AIRTABLE_MAP["datetime"]: "2022-08-01T09:00:00.000Z"},
+            ),
+            {},
+        )
+        self.assertEqual(
+            changed_fields(
+                {AIRTABLE_MAP["datetime"]: "2022-08-01T11:00:00+01:00"},
+                {AIRTABLE_MAP["datetime"]: "2022-08-01T09:00:00.000Z"},
+            ),
+            {AIRTABLE_MAP["datetime"]: "2022-08-01T11:00:00+01:00"},
+        )
+
+    def test_missing_checkbox_is_false(self) -> None:
+        self.assertEqual(changed_fields({AIRTABLE_MAP["cancelled"]: False}, {}), {})
+        self.assertEqual(
+            changed_fields({AIRTABLE_MAP["cancelled"]: True}, {}),
+            {AIRTABLE_MAP["cancelled"]: True},
+        )
+
+    def test_attachments_match_on_filename(self) -> None:
+        planned = {
+            AIRTABLE_MAP["churchsuite_image"]: [
+                {"url": "https://example.com/lg/1m4g3.jpg"}
+            ]
+        }
+
+        self.assertEqual(
+            changed_fields(
+                planned,
+                {
+                    AIRTABLE_MAP["churchsuite_image"]: [
+                        {
+                            "id": "attAbC",
+                            "url": "https://dl.airtable.com/xYz/1m4g3.jpg",
+                            "filename": "1m4g3.jpg",
+                        }
+                    ]
+                },
+            ),
+            {},
+        )
+        self.assertEqual(
+            changed_fields(
+                planned,
+                {
+                    AIRTABLE_MAP["churchsuite_image"]: [
+                        {
+                            "id": "attAbC",
+                            "url": "https://dl.airtable.com/xYz/0th3r.jpg",
+                            "filename": "0th3r.jpg",
+                        }
+                    ]
+                },
+            ),
+            planned,
+        )
+        self.assertEqual(changed_fields(planned, {}), planned)
+
+
+if __name__ == "__main__":
+    unittest.main()
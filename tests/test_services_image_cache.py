@@ -0,0 +1,86 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from services.image_cache import ImageCache
+
+
+def responseFactory(status_code: int = 200, content: bytes = b"", headers=None):
+    response = MagicMock()
+    response.__enter__.return_value = response
+    response.status_code = status_code
+    response.headers = headers or {}
+    response.iter_content.return_value = [content]
+    return response
+
+
+class testImageCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.session = MagicMock()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def cacheFactory(self, **kwargs) -> ImageCache:
+        return ImageCache(self.directory.name, session=self.session, **kwargs)
+
+    def test_stores_images_by_content_digest(self) -> None:
+        self.session.get.return_value = responseFactory(content=b"1m4g3")
+
+        path = self.cacheFactory().get("https://example.com/a.JPG", "a.JPG", "attOnE")
+
+        self.assertEqual(
+            path,
+            os.path.join(
+                self.directory.name, hashlib.sha256(b"1m4g3").hexdigest() + ".jpg"
+            ),
+        )
+        with open(path, "rb") as image_file:
+            self.assertEqual(image_file.read(), b"1m4g3")
+
+    def test_downloads_at_most_once_per_run(self) -> None:
+        self.session.get.return_value = responseFactory(content=b"1m4g3")
+        cache = self.cacheFactory()
+
+        cache.get("https://example.com/a.jpg?sig=1", "a.jpg", "attOnE")
+        cache.get("https://example.com/a.jpg?sig=2", "a.jpg", "attOnE")
+
+        self.session.get.assert_called_once()
+
+    def test_revalidates_with_conditional_get_across_runs(self) -> None:
+        self.session.get.return_value = responseFactory(
+            content=b"1m4g3",
+            headers={"ETag": '"abc"', "Last-Modified": "Sat, 01 Jan 2022 10:00:00 GMT"},
+        )
+        first_path = self.cacheFactory().get("https://example.com/a.jpg", "a.jpg")
+
+        self.session.get.return_value = responseFactory(status_code=304)
+        second_path = self.cacheFactory().get("https://example.com/a.jpg", "a.jpg")
+
+        self.assertEqual(first_path, second_path)
+        self.assertEqual(
+            self.session.get.call_args.kwargs["headers"],
+            {
+                "If-None-Match": '"abc"',
+                "If-Modified-Since": "Sat, 01 Jan 2022 10:00:00 GMT",
+            },
+        )
+
+    def test_evicts_least_recently_used_images_over_size_limit(self) -> None:
+        self.session.get.return_value = responseFactory(content=b"0ld")
+        old_path = self.cacheFactory().get("https://example.com/old.jpg", "old.jpg")
+
+        self.session.get.return_value = responseFactory(content=b"n3w")
+        cache = self.cacheFactory(max_bytes=3)
+        new_path = cache.get("https://example.com/new.jpg", "new.jpg")
+
+        self.assertFalse(os.path.exists(old_path))
+        self.assertTrue(os.path.exists(new_path))
+        self.assertEqual(list(cache.entries), ["https://example.com/new.jpg"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import datetime
+import tempfile
+import unittest
+from unittest.mock import MagicMock, call, patch
+
+from services import AIRTABLE_MAP, ServiceRepository
+from services.snapshot import ServiceSnapshot
+
+NOW = datetime.datetime(2022, 1, 1, 9, 0, tzinfo=datetime.timezone.utc)
+
+
+def recordFactory(id: str, datetime_field: str, **fields) -> dict:
+    return {"id": id, "fields": {AIRTABLE_MAP["datetime"]: datetime_field, **fields}}
+
+
+@patch("services.snapshot.utc_now", lambda: NOW)
+class testServiceSnapshot(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.services_table = MagicMock()
+        self.snapshot = ServiceSnapshot(
+            self.services_table, path=self.directory.name + "/snapshot.sqlite3"
+        )
+
+    def tearDown(self) -> None:
+        self.snapshot.close()
+        self.directory.cleanup()
+
+    def test_first_refresh_is_full(self) -> None:
+        self.services_table.all.return_value = [
+            recordFactory("recOnE", "2022-01-02T10:00:00.000Z")
+        ]
+
+        result = self.snapshot.refresh()
+
+        self.assertTrue(result["full"])
+        self.assertEqual(
+            self.services_table.all.call_args_list,
+            [
+                call(fields=[AIRTABLE_MAP["datetime"]]),
+                call(formula="{" + AIRTABLE_MAP["datetime"] + "} >= TODAY()"),
+            ],
+        )
+
+    def test_later_refreshes_only_fetch_changes(self) -> None:
+        self.services_table.all.return_value = [
+            recordFactory("recOnE", "2022-01-02T10:00:00.000Z", Name="Old")
+        ]
+        self.snapshot.refresh()
+
+        self.services_table.all.return_value = [
+            recordFactory("recOnE", "2022-01-02T10:00:00.000Z", Name="New")
+        ]
+        result = self.snapshot.refresh()
+
+        self.assertFalse(result["full"])
+        self.services_table.all.assert_called_with(
+            formula="IS_AFTER(LAST_MODIFIED_TIME(), DATETIME_PARSE('2022-01-01T08:55:00.000Z'))"
+        )
+        self.assertEqual(self.snapshot.upcoming_records()[0]["fields"]["Name"], "New")
+
+    def test_full_resync_detects_deletions(self) -> None:
+        self.services_table.all.return_value = [
+            recordFactory("recOnE", "2022-01-02T10:00:00.000Z"),
+            recordFactory("recTwO", "2022-01-03T10:00:00.000Z"),
+        ]
+        self.snapshot.refresh()
+
+        self.services_table.all.return_value = [
+            recordFactory("recOnE", "2022-01-02T10:00:00.000Z")
+        ]
+        self.snapshot.request_full_resync()
+        result = self.snapshot.refresh()
+
+        self.assertTrue(result["full"])
+        self.assertEqual(result["deleted"], 1)
+        self.assertEqual(
+            [record["id"] for record in self.snapshot.upcoming_records()], ["recOnE"]
+        )
+
+    def test_full_resync_keeps_records_that_are_only_past(self) -> None:
+        self.services_table.all.return_value = [
+            recordFactory("recPaSt", "2021-12-25T10:00:00.000Z"),
+            recordFactory("recOnE", "2022-01-02T10:00:00.000Z"),
+        ]
+        self.snapshot.refresh()
+
+        # Past services come back from the ID scan, but not the upcoming fetch
+        def all_records(**kwargs):
+            records = [recordFactory("recOnE", "2022-01-02T10:00:00.000Z")]
+
+            if "fields" in kwargs:
+                records.append(recordFactory("recPaSt", "2021-12-25T10:00:00.000Z"))
+
+            return records
+
+        self.services_table.all.side_effect = all_records
+        self.snapshot.request_full_resync()
+        result = self.snapshot.refresh()
+
+        self.assertEqual(result["deleted"], 0)
+        self.assertEqual(result["fetched"], 1)
+
+    def test_upcoming_records_are_sorted_and_exclude_the_past(self) -> None:
+        self.services_table.all.return_value = [
+            recordFactory("recLaTeR", "2022-01-09T10:00:00.000Z"),
+            recordFactory("recPaSt", "2021-12-25T10:00:00.000Z"),
+            recordFactory("recToDaY", "2022-01-01T08:00:00.000Z"),
+        ]
+        self.snapshot.refresh()
+
+        self.assertEqual(
+            [record["id"] for record in self.snapshot.upcoming_records()],
+            ["recToDaY", "recLaTeR"],
+        )
+
+    def test_repository_reads_from_snapshot(self) -> None:
+        self.services_table.all.return_value = [
+            recordFactory(
+                "recStReAm",
+                "2022-01-02T10:00:00.000Z",
+                **{AIRTABLE_MAP["streaming"]: "Yes"},
+            )
+        ]
+
+        repository = ServiceRepository(self.services_table, snapshot=self.snapshot)
+
+        self.assertEqual(
+            [service.id for service in repository.streaming_services()], ["recStReAm"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
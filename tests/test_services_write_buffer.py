@@ -0,0 +1,226 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+import requests
+
+from services import AIRTABLE_MAP, ServiceRepository
+from services.write_buffer import WriteBuffer
+
+
+def reject_batch(records: list[dict]) -> None:
+    response = requests.Response()
+    response.status_code = 422
+    raise requests.HTTPError("Invalid records", response=response)
+
+
+class FakeTable:
+    # Just enough of a table to read back what's been written to it
+    def __init__(self, records: list[dict]) -> None:
+        self.records = {record["id"]: record for record in records}
+
+    def all(self, **kwargs) -> list[dict]:
+        return list(self.records.values())
+
+    def batch_update(self, records: list[dict]) -> None:
+        for record in records:
+            self.records[record["id"]]["fields"].update(record["fields"])
+
+
+class testWriteBuffer(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.journal_path = os.path.join(self.directory.name, "writes.jsonl")
+        self.rejected_path = os.path.join(self.directory.name, "rejected.jsonl")
+        self.services_table = MagicMock()
+
+    def bufferFactory(self, **kwargs) -> WriteBuffer:
+        write_buffer = WriteBuffer(
+            self.services_table,
+            journal_path=self.journal_path,
+            rejected_path=self.rejected_path,
+            **kwargs,
+        )
+        self.addCleanup(write_buffer.close)
+        return write_buffer
+
+    def test_updates_are_merged_per_record(self) -> None:
+        write_buffer = self.bufferFactory()
+        write_buffer.update("recA", {AIRTABLE_MAP["oos_id"]: "1"})
+        write_buffer.update("recA", {AIRTABLE_MAP["podcast_id"]: "2"})
+        write_buffer.update("recB", {AIRTABLE_MAP["oos_id"]: "3"})
+
+        self.services_table.batch_update.assert_not_called()
+
+        write_buffer.flush()
+
+        self.services_table.batch_update.assert_called_once_with(
+            [
+                {
+                    "id": "recA",
+                    "fields": {
+                        AIRTABLE_MAP["oos_id"]: "1",
+                        AIRTABLE_MAP["podcast_id"]: "2",
+                    },
+                },
+                {"id": "recB", "fields": {AIRTABLE_MAP["oos_id"]: "3"}},
+            ]
+        )
+        self.assertEqual(len(write_buffer), 0)
+
+    def test_records_are_sent_ten_at_a_time(self) -> None:
+        write_buffer = self.bufferFactory(max_records=25)
+
+        for number in range(25):
+            write_buffer.update("rec{}".format(number), {"Field": number})
+
+        self.assertEqual(
+            [len(call.args[0]) for call in self.services_table.batch_update.mock_calls],
+            [10, 10, 5],
+        )
+
+    def test_closing_flushes(self) -> None:
+        write_buffer = self.bufferFactory()
+        write_buffer.update("recA", {"Field": "value"})
+        write_buffer.close()
+
+        self.services_table.batch_update.assert_called_once()
+
+    def test_unsent_updates_are_sent_as_soon_as_the_journal_is_read(self) -> None:
+        write_buffer = self.bufferFactory()
+        write_buffer.update("recA", {AIRTABLE_MAP["youtube_id"]: "a1-b2_c3"})
+
+        # As if the run died before getting to send anything
+        assert write_buffer.journal is not None
+        write_buffer.journal.close()
+        write_buffer.journal = None
+        write_buffer.pending = {}
+
+        replayed = self.bufferFactory()
+
+        self.services_table.batch_update.assert_called_once_with(
+            [{"id": "recA", "fields": {AIRTABLE_MAP["youtube_id"]: "a1-b2_c3"}}]
+        )
+        self.assertEqual(replayed.pending, {})
+
+    def test_recovered_ids_are_seen_by_the_repository(self) -> None:
+        fake_table = FakeTable(
+            [{"id": "recStReAm", "fields": {AIRTABLE_MAP["streaming"]: "Yes"}}]
+        )
+        table = MagicMock(all=fake_table.all, batch_update=fake_table.batch_update)
+
+        with open(self.journal_path, "w") as journal:
+            journal.write(
+                json.dumps(
+                    {
+                        "id": "recStReAm",
+                        "fields": {AIRTABLE_MAP["youtube_id"]: "OlDvIdEo"},
+                    }
+                )
+                + "\n"
+            )
+
+        write_buffer = WriteBuffer(table, journal_path=self.journal_path)
+        self.addCleanup(write_buffer.close)
+        repository = ServiceRepository(table, write_buffer=write_buffer)
+
+        self.assertEqual(repository.streaming_services()[0].youtube_id, "OlDvIdEo")
+
+    def test_journal_is_kept_if_airtable_fails(self) -> None:
+        self.services_table.batch_update.side_effect = Exception("Airtable is down")
+
+        write_buffer = self.bufferFactory()
+        write_buffer.update("recA", {"Field": "value"})
+
+        with self.assertRaises(Exception):
+            write_buffer.flush()
+
+        # The next run can't start until Airtable has what this one didn't send
+        with self.assertRaises(Exception):
+            WriteBuffer(self.services_table, journal_path=self.journal_path)
+
+        self.services_table.batch_update.side_effect = None
+        self.services_table.batch_update.reset_mock()
+
+        self.bufferFactory()
+
+        self.services_table.batch_update.assert_called_once_with(
+            [{"id": "recA", "fields": {"Field": "value"}}]
+        )
+
+    def test_rejected_records_are_set_aside(self) -> None:
+        def reject(record_id, fields):
+            if record_id == "recGoNe":
+                response = requests.Response()
+                response.status_code = 422
+                raise requests.HTTPError("Record not found", response=response)
+
+        self.services_table.batch_update.side_effect = reject_batch
+        self.services_table.update.side_effect = reject
+
+        write_buffer = self.bufferFactory()
+        write_buffer.update("recA", {"Field": "value"})
+        write_buffer.update("recGoNe", {"Field": "value"})
+        write_buffer.flush()
+
+        self.services_table.update.assert_any_call("recA", {"Field": "value"})
+        self.assertEqual(len(write_buffer), 0)
+        self.assertEqual(os.path.getsize(self.journal_path), 0)
+
+        with open(self.rejected_path) as rejected:
+            self.assertEqual(
+                [json.loads(line) for line in rejected],
+                [{"id": "recGoNe", "fields": {"Field": "value"}}],
+            )
+
+    def test_journal_keeps_only_what_is_unsent(self) -> None:
+        def fail_second_batch(records):
+            if records[0]["id"] == "rec10":
+                raise Exception("Airtable is down")
+
+        self.services_table.batch_update.side_effect = fail_second_batch
+
+        write_buffer = self.bufferFactory()
+
+        for number in range(11):
+            write_buffer.update("rec{}".format(number), {"Field": number})
+
+        with self.assertRaises(Exception):
+            write_buffer.flush()
+
+        with open(self.journal_path) as journal:
+            self.assertEqual([json.loads(line)["id"] for line in journal], ["rec10"])
+
+        self.services_table.batch_update.side_effect = None
+
+    def test_journal_is_emptied_once_sent(self) -> None:
+        write_buffer = self.bufferFactory()
+        write_buffer.update("recA", {"Field": "value"})
+        write_buffer.flush()
+
+        self.assertEqual(os.path.getsize(self.journal_path), 0)
+
+    def test_repository_writes_through_the_buffer(self) -> None:
+        self.services_table.all.return_value = [
+            {"id": "recStReAm", "fields": {AIRTABLE_MAP["streaming"]: "Yes"}}
+        ]
+        repository = ServiceRepository(
+            self.services_table, write_buffer=self.bufferFactory()
+        )
+
+        repository.streaming_services()
+        repository.update("recStReAm", {AIRTABLE_MAP["youtube_id"]: "a1-b2_c3"})
+
+        self.services_table.update.assert_not_called()
+        self.assertEqual(repository.streaming_services()[0].youtube_id, "a1-b2_c3")
+
+        repository.invalidate()
+
+        self.services_table.batch_update.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()